@@ -78,12 +78,11 @@ class BasicAuth(Auth):
         if user_pwd is None or not isinstance(user_pwd, str):
             return None
         try:
-            found_users = User.search({'email': user_email})
+            for user in User.query().where(email=user_email):
+                if user.is_valid_password(user_pwd):
+                    return user
         except Exception:
             return None
-        for user in found_users:
-            if user.is_valid_password(user_pwd):
-                return user
         return None
 
     def current_user(self, request=None) -> TypeVar('User'):
@@ -7,5 +7,13 @@ app_views = Blueprint("app_views", __name__, url_prefix="/api/v1")
 
 from api.v1.views.index import *
 from api.v1.views.users import *
+from api.v1.views.changes import *
 
 User.load_from_file()
+
+
+@app_views.before_app_request
+def refresh_store() -> None:
+    """ Apply the changes other workers made to the store
+    """
+    User.refresh()
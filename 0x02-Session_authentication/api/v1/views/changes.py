@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+""" Module of Changes views
+"""
+from api.v1.views import app_views
+from flask import jsonify, request
+from models.changes import FEED
+from models.user import User
+import math
+import time
+
+
+MAX_TIMEOUT = 60
+
+
+@app_views.route('/changes', methods=['GET'], strict_slashes=False)
+def view_changes() -> str:
+    """ GET /api/v1/changes
+    Query parameters (optional):
+      - since: version of the last change seen; without it, only the
+        current version is returned
+      - feed: feed of that version; versions are counted by each
+        worker, so a since from another feed is reported as truncated
+      - timeout: seconds to wait for a change (long-poll, default: 30,
+        at most 60)
+    Return:
+      - feed: id of this worker's feed
+      - version: current version
+      - changes: list of {class, id, op, version} after `since`, op
+        being save, remove or reload (the whole store was reloaded)
+      - truncated: true if older changes are no longer kept
+      - 400 if a parameter is wrong
+    """
+    try:
+        since = request.args.get('since')
+        since = None if since is None else int(since)
+        timeout = float(request.args.get('timeout', 30))
+        if not math.isfinite(timeout) or timeout < 0 or (
+                since is not None and since < 0):
+            raise ValueError(timeout)
+    except ValueError:
+        return jsonify({'error': "Wrong parameters"}), 400
+    changes, truncated = [], False
+    version = FEED.version
+    feed = request.args.get('feed')
+    if since is not None and feed is not None and feed != FEED.id:
+        truncated = True
+    elif since is not None:
+        version = since
+        deadline = time.monotonic() + min(timeout, MAX_TIMEOUT)
+        while True:
+            # Other workers' changes show up when the store is refreshed
+            User.refresh()
+            remaining = deadline - time.monotonic()
+            changes, truncated = FEED.since(since, max(0, min(remaining, 1)))
+            if changes or truncated or time.monotonic() >= deadline:
+                break
+        if changes:
+            version = changes[-1].version
+        elif truncated:
+            version = FEED.version
+    return jsonify({'feed': FEED.id, 'version': version,
+                    'truncated': truncated,
+                    'changes': [{'class': change.s_class, 'id': change.id,
+                                 'op': change.op, 'version': change.version}
+                                for change in changes]})
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """ Module of Index views
 """
-from flask import jsonify, abort
+from flask import Response, jsonify, abort, request
 from api.v1.views import app_views
+from models.metrics import METRICS
 
 
 @app_views.route('/status', methods=['GET'], strict_slashes=False)
@@ -19,8 +20,30 @@ def stats() -> str:
     """ GET /api/v1/stats
     Return:
       - the number of each objects
+      - the number of users created per day, without name and by
+        email domain
     """
     from models.user import User
     stats = {}
     stats['users'] = User.count()
+    stats['users_created_per_day'] = User.aggregate('created_per_day')
+    stats['users_without_name'] = User.aggregate('without_name').get(True, 0)
+    stats['users_by_email_domain'] = User.aggregate('email_domain')
     return jsonify(stats)
+
+
+@app_views.route('/metrics', methods=['GET'], strict_slashes=False)
+def metrics() -> str:
+    """ GET /api/v1/metrics
+    Query parameter (optional):
+      - format: prometheus (default) or json
+    Return:
+      - the store metrics of each class (load time and objects, write
+        and save_to_file latency histograms, bytes written, searches with
+        scanned and returned objects, objects in the store and in memory)
+        in the Prometheus text format, or as JSON by class
+    """
+    if request.args.get('format') == 'json':
+        return jsonify(METRICS.snapshot())
+    return Response(METRICS.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
@@ -1,19 +1,100 @@
 #!/usr/bin/env python3
 """ Module of Users views
 """
+from typing import Iterable, Iterator
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, current_app, jsonify, request, \
+    stream_with_context
+from models.base import VersionConflict
 from models.user import User
 
 
+def _stream_json_array(objs: Iterable[dict],
+                       chunk_size: int = 100) -> Iterator[str]:
+    """ Encode a JSON array chunk by chunk
+    """
+    dumps = current_app.json.dumps
+    separator = ''
+    chunk = []
+    yield '['
+    for obj in objs:
+        chunk.append(dumps(obj))
+        if len(chunk) == chunk_size:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+
+
+def _with_etag(response: Response, user: User) -> Response:
+    """ Set the ETag of a response to the version of user
+    """
+    response.set_etag(str(user.version))
+    return response
+
+
+def _precondition(user: User) -> bool:
+    """ False if the request has an If-Match header not matching the
+    current version of user
+    """
+    if not request.if_match:
+        return True
+    return request.if_match.contains(str(user.version))
+
+
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters (optional, keyset pagination):
+      - limit: maximum number of users (default: 100 when `after` is set)
+      - after: cursor of the next page (X-Next-Cursor header)
+      - order_by: id (default) or created_at
+    Return:
+      - list of all User objects JSON represented, streamed
+      - one page of User objects if limit or after is set
+      - 400 if the pagination parameters are wrong
+    """
+    public = User.codec().public
+    if 'limit' not in request.args and 'after' not in request.args:
+        users = (public(user) for user in User.scan())
+        return Response(stream_with_context(_stream_json_array(users)),
+                        mimetype='application/json')
+    order_by = request.args.get('order_by', 'id')
+    try:
+        limit = int(request.args.get('limit', 100))
+        if limit <= 0:
+            raise ValueError(limit)
+        users = User.page(limit, request.args.get('after'), order_by)
+    except ValueError:
+        return jsonify({'error': "Wrong pagination"}), 400
+    response = jsonify([public(user) for user in users])
+    if len(users) == limit:
+        response.headers['X-Next-Cursor'] = users[-1].cursor(order_by)
+    return response
+
+
+@app_views.route('/users/search', methods=['GET'], strict_slashes=False)
+def search_users() -> str:
+    """ GET /api/v1/users/search
+    Query parameters:
+      - q: words starting words of the email, first_name or last_name
+      - limit (optional): maximum number of users (default: 10)
     Return:
-      - list of all User objects JSON represented
+      - list of matching User objects JSON represented (not ranked:
+        alphabetical by matched word with the JSON engine, in storage
+        order with the others)
+      - 400 if limit is wrong
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    try:
+        limit = int(request.args.get('limit', 10))
+        if limit <= 0:
+            raise ValueError(limit)
+    except ValueError:
+        return jsonify({'error': "Wrong limit"}), 400
+    users = User.text_search(request.args.get('q', ''), limit)
+    return jsonify([user.to_json() for user in users])
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -22,7 +103,7 @@ def view_one_user(user_id: str = None) -> str:
     Path parameter:
       - User ID
     Return:
-      - User object JSON represented
+      - User object JSON represented, its version as ETag
       - 404 if the User ID doesn't exist
     """
     if user_id is None:
@@ -30,7 +111,7 @@ def view_one_user(user_id: str = None) -> str:
     user = User.get(user_id)
     if user is None:
         abort(404)
-    return jsonify(user.to_json())
+    return _with_etag(jsonify(user.to_json()), user)
 
 
 @app_views.route('/users/<user_id>', methods=['DELETE'], strict_slashes=False)
@@ -38,16 +119,24 @@ def delete_user(user_id: str = None) -> str:
     """ DELETE /api/v1/users/:id
     Path parameter:
       - User ID
+    Header (optional):
+      - If-Match: ETag of the User version to delete
     Return:
       - empty JSON is the User has been correctly deleted
       - 404 if the User ID doesn't exist
+      - 412 if the User isn't at the If-Match version (anymore)
     """
     if user_id is None:
         abort(404)
     user = User.get(user_id)
     if user is None:
         abort(404)
-    user.remove()
+    if not _precondition(user):
+        return jsonify({'error': "Precondition failed"}), 412
+    try:
+        user.remove(user.version if request.if_match else None)
+    except VersionConflict:
+        return jsonify({'error': "Precondition failed"}), 412
     return jsonify({}), 200
 
 
@@ -83,7 +172,7 @@ def create_user() -> str:
             user.first_name = rj.get("first_name")
             user.last_name = rj.get("last_name")
             user.save()
-            return jsonify(user.to_json()), 201
+            return _with_etag(jsonify(user.to_json()), user), 201
         except Exception as e:
             error_msg = "Can't create User: {}".format(e)
     return jsonify({'error': error_msg}), 400
@@ -94,19 +183,26 @@ def update_user(user_id: str = None) -> str:
     """ PUT /api/v1/users/:id
     Path parameter:
       - User ID
+    Header (optional):
+      - If-Match: ETag of the User version the update is based on
     JSON body:
       - last_name (optional)
       - first_name (optional)
     Return:
-      - User object JSON represented
+      - User object JSON represented, its new version as ETag
       - 404 if the User ID doesn't exist
       - 400 if can't update the User
+      - 412 if the User isn't at the If-Match version (anymore)
+    The update is a compare-and-set on the version read: no lock is held
+    while the request is processed.
     """
     if user_id is None:
         abort(404)
     user = User.get(user_id)
     if user is None:
         abort(404)
+    if not _precondition(user):
+        return jsonify({'error': "Precondition failed"}), 412
     rj = None
     try:
         rj = request.get_json()
@@ -114,9 +210,117 @@ def update_user(user_id: str = None) -> str:
         rj = None
     if rj is None:
         return jsonify({'error': "Wrong format"}), 400
+    # Edit a copy: the stored instance is shared with other requests
+    user = user.copy()
     if rj.get('first_name') is not None:
         user.first_name = rj.get('first_name')
     if rj.get('last_name') is not None:
         user.last_name = rj.get('last_name')
-    user.save()
-    return jsonify(user.to_json()), 200
+    try:
+        user.save(user.version if request.if_match else None)
+    except VersionConflict:
+        return jsonify({'error': "Precondition failed"}), 412
+    return _with_etag(jsonify(user.to_json()), user), 200
+
+
+@app_views.route('/users/batch', methods=['POST'], strict_slashes=False)
+def batch_save_users() -> str:
+    """ POST /api/v1/users/batch
+    JSON body: list of users, each one:
+      - id (optional): update this User (first_name/last_name)
+      - version (optional, with id): update only if the User is still
+        at this version
+      - email, password: required to create a User
+      - last_name (optional)
+      - first_name (optional)
+    Return:
+      - list of results in the order of the body, each one with the
+        `status` of the item (201 created, 200 updated, 400, 404, 412)
+        and the User JSON represented or an `error`
+      - 400 if the body isn't a list
+    All valid items are saved at once, the updates as compare-and-set
+    on their version when it is given.
+    """
+    try:
+        rj = request.get_json()
+    except Exception as e:
+        rj = None
+    if type(rj) is not list:
+        return jsonify({'error': "Wrong format"}), 400
+    results = []
+    saved = []
+    users = []
+    versions = []
+    for item in rj:
+        if type(item) is not dict:
+            results.append({'status': 400, 'error': "Wrong format"})
+            continue
+        version = item.get('version')
+        if version is not None and (item.get('id') is None or
+                                    type(version) is not int):
+            results.append({'status': 400, 'error': "Wrong version"})
+            continue
+        if item.get('id') is not None:
+            user = User.get(item.get('id'))
+            if user is None:
+                results.append({'status': 404, 'error': "Not found"})
+                continue
+            if version is not None and user.version != version:
+                results.append({'status': 412,
+                                'error': "Precondition failed"})
+                continue
+            # Edit a copy: the stored instance is shared with other requests
+            user = user.copy()
+            status = 200
+        elif item.get("email", "") == "":
+            results.append({'status': 400, 'error': "email missing"})
+            continue
+        elif item.get("password", "") == "":
+            results.append({'status': 400, 'error': "password missing"})
+            continue
+        else:
+            user = User()
+            user.email = item.get("email")
+            user.password = item.get("password")
+            status = 201
+        if status == 201 or item.get('first_name') is not None:
+            user.first_name = item.get('first_name')
+        if status == 201 or item.get('last_name') is not None:
+            user.last_name = item.get('last_name')
+        results.append({'status': status, 'user': user})
+        saved.append(results[-1])
+        users.append(user)
+        versions.append(version)
+    try:
+        done = User.bulk_save(users, versions)
+    except Exception as e:
+        return jsonify({'error': "Can't save Users: {}".format(e)}), 400
+    for result, ok in zip(saved, done):
+        if ok:
+            result['user'] = result.pop('user').to_json()
+        else:
+            del result['user']
+            result.update({'status': 412, 'error': "Precondition failed"})
+    return jsonify(results), 200
+
+
+@app_views.route('/users/batch', methods=['DELETE'], strict_slashes=False)
+def batch_delete_users() -> str:
+    """ DELETE /api/v1/users/batch
+    JSON body:
+      - list of User IDs
+    Return:
+      - list of results in the order of the body: {id, status} with
+        status 200 if the User has been deleted, 404 if it doesn't exist
+      - 400 if the body isn't a list of IDs
+    All Users are removed at once.
+    """
+    try:
+        rj = request.get_json()
+    except Exception as e:
+        rj = None
+    if type(rj) is not list or any(type(i) is not str for i in rj):
+        return jsonify({'error': "Wrong format"}), 400
+    deleted = User.bulk_remove(rj)
+    return jsonify([{'id': user_id, 'status': 200 if done else 404}
+                    for user_id, done in zip(rj, deleted)]), 200
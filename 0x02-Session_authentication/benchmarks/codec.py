@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" Throughput benchmark: precompiled codecs vs the __dict__ loop
+
+Usage (from the project directory):
+    python3 -m benchmarks.codec [count]
+"""
+from datetime import datetime
+import sys
+import time
+from benchmarks.memory import DictUser, sample
+from models.base import TIMESTAMP_FORMAT
+from models.user import User
+
+
+def dict_to_json(obj, for_serialization: bool = False) -> dict:
+    """ Base.to_json as it was: loop over __dict__ with strftime
+    """
+    result = {}
+    for key, value in obj.__dict__.items():
+        if not for_serialization and key[0] == '_':
+            continue
+        if type(value) is datetime:
+            result[key] = value.strftime(TIMESTAMP_FORMAT)
+        else:
+            result[key] = value
+    return result
+
+
+def rate(func, items: list) -> float:
+    """ Items per second processed by func
+    """
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    records = sample(count)
+    codec = User.codec()
+    legacy = [DictUser(**record) for record in records]
+    users = [codec.load(record) for record in records]
+    results = [
+        ("decode", rate(lambda r: DictUser(**r), records),
+         rate(codec.load, records)),
+        ("encode (public)", rate(dict_to_json, legacy),
+         rate(codec.public, users)),
+        ("encode (serialization)",
+         rate(lambda o: dict_to_json(o, True), legacy),
+         rate(codec.dump, users)),
+    ]
+    print("users: {}".format(count))
+    for name, before, after in results:
+        print("{:<24} {:>10.0f}/s -> {:>10.0f}/s  x{:.1f}".format(
+            name, before, after, after / before))
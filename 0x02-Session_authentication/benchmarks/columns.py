@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Analytic queries: loop over User.all() vs the columnar shadow
+
+Over `count` synthetic users spread over 30 days (a tenth without first
+name, 20 email domains), computes users per hour of created_at, users
+without first name and users per email domain, by looping over
+User.all() then with User.columns() (first call, which builds the
+shadow, then a copy of the maintained one), with NumPy and without.
+
+Usage (writes .db_User.json in a temporary directory):
+    python3 -m benchmarks.columns [count]
+"""
+from datetime import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+from benchmarks.memory import sample
+from models.codec import encode_timestamp
+import models.columns
+from models.user import User, email_domain
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def records(count: int) -> dict:
+    """ Serialized users with varied created_at, names and domains
+    """
+    start = int(time.time()) - 30 * 86400
+    objs = {}
+    for i, record in enumerate(sample(count)):
+        record['created_at'] = record['updated_at'] = \
+            encode_timestamp(start + i * 30 * 86400 // count)
+        record['email'] = 'user{}@domain{}.com'.format(i, i % 20)
+        if i % 10 == 0:
+            record['first_name'] = None
+        objs[record['id']] = record
+    return objs
+
+
+def with_loop() -> tuple:
+    """ The three aggregates from the objects
+    """
+    hours = {}
+    without_name = 0
+    domains = {}
+    for user in User.all():
+        hour = int((user.created_at - EPOCH).total_seconds()) // 3600 * 3600
+        hours[hour] = hours.get(hour, 0) + 1
+        if user.first_name is None:
+            without_name += 1
+        domain = email_domain({'email': user.email})
+        domains[domain] = domains.get(domain, 0) + 1
+    return hours, without_name, domains
+
+
+def with_columns() -> tuple:
+    """ The three aggregates from the columns
+    """
+    columns = User.columns()
+    return (columns.histogram('created_at', 3600),
+            columns.null_count('first_name'),
+            columns.value_counts('email_domain'))
+
+
+def timed(function) -> tuple:
+    """ (seconds, result) of one call
+    """
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open('.db_User.json', 'w') as f:
+            json.dump(records(count), f)
+        User.load_from_file()
+        print("users: {}, numpy: {}".format(
+            count, models.columns.numpy is not None))
+        loop, expected = timed(with_loop)
+        print("loop over User.all(): {:.3f} s".format(loop))
+        built, result = timed(with_columns)
+        assert result == expected
+        print("columns, first call (build): {:.3f} s".format(built))
+        if models.columns.numpy is not None:
+            numpy, result = timed(with_columns)
+            assert result == expected
+            print("columns, numpy: {:.4f} s ({:.0f}x)".format(
+                numpy, loop / numpy))
+            models.columns.numpy = None
+        arrays, result = timed(with_columns)
+        assert result == expected
+        print("columns, array loops: {:.4f} s ({:.0f}x)".format(
+            arrays, loop / arrays))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+""" Plain vs gzip-compressed store files: size, CPU time and I/O time
+
+Writes and reads back `count` synthetic users with the JSON engine's
+write_fragments/read_json, plain then gzip at several levels, and adds
+the time to move the bytes at `bandwidth` MB/s (a network volume) to
+show where compression pays off.
+
+Usage (from the project directory):
+    python3 -m benchmarks.compression [count] [bandwidth MB/s]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from benchmarks.memory import sample
+from models.engines.json_file import read_json, write_fragments
+
+
+def measure(file_path: str, fragments: list, level: int) -> tuple:
+    """ (bytes, write seconds, read seconds) of one format
+    """
+    start = time.perf_counter()
+    write_fragments(file_path, fragments, level)
+    written = time.perf_counter() - start
+    start = time.perf_counter()
+    read_json(file_path)
+    read = time.perf_counter() - start
+    return os.path.getsize(file_path), written, read
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bandwidth = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    fragments = [(record['id'], json.dumps(record))
+                 for record in sample(count)]
+    print("users: {}, I/O at {:.0f} MB/s".format(count, bandwidth))
+    print("{:>8} {:>10} {:>9} {:>9} {:>12} {:>12}".format(
+        "format", "MB", "write s", "read s", "save+I/O s", "load+I/O s"))
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, '.db_User.json')
+        for level in (None, 1, 6, 9):
+            size, written, read = measure(file_path, fragments, level)
+            io = size / (bandwidth * 1e6)
+            print("{:>8} {:>10.2f} {:>9.3f} {:>9.3f} {:>12.3f} {:>12.3f}"
+                  .format("plain" if level is None else "gzip-{}".format(
+                      level), size / 1e6, written, read, written + io,
+                      read + io))
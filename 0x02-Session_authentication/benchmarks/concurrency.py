@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" Multithreaded stress test and throughput of the User store
+
+Usage (writes .db_User.json in the current directory):
+    PYTHONPATH=<project directory> python3 -m benchmarks.concurrency \
+        [users] [seconds]
+"""
+import json
+import random
+import sys
+import threading
+import time
+from models.user import User
+
+
+def worker(stop: threading.Event, ids: list, write_ratio: float,
+           counts: list, errors: list):
+    """ Mixed get/search/all/save/remove until stop is set
+    """
+    ops = 0
+    rand = random.Random()
+    try:
+        while not stop.is_set():
+            roll = rand.random()
+            if roll < write_ratio / 2:
+                user = User(email='new{}@example.com'.format(rand.random()))
+                user.save()
+                ids.append(user.id)
+            elif roll < write_ratio:
+                user = User.get(rand.choice(ids))
+                if user is not None:
+                    user.remove()
+            elif roll < 0.5:
+                User.get(rand.choice(ids))
+            elif roll < 0.9:
+                User.search({'email': 'user{}@example.com'.format(
+                    rand.randrange(len(ids)))})
+            else:
+                User.page(20, None, 'created_at')
+            ops += 1
+    except Exception as e:
+        errors.append(e)
+    counts.append(ops)
+
+
+def run(threads: int, seconds: float, ids: list,
+        write_ratio: float) -> tuple:
+    """ (ops/s, errors) of `threads` workers running for `seconds`
+    """
+    stop = threading.Event()
+    counts, errors = [], []
+    pool = [threading.Thread(target=worker,
+                             args=(stop, ids, write_ratio, counts, errors))
+            for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in pool:
+        thread.join()
+    return sum(counts) / seconds, errors
+
+
+def check_file() -> bool:
+    """ True if .db_User.json holds exactly the objects in memory
+    """
+    User.save_to_file()
+    with open(".db_User.json") as f:
+        saved = json.load(f)
+    return set(saved) == set(user.id for user in User.all())
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    User.load_from_file()
+    for i in range(count - User.count()):
+        User(id='u{}'.format(i), email='user{}@example.com'.format(i)).save()
+    ids = [user.id for user in User.all()]
+
+    _, errors = run(8, seconds, ids, 0.2)
+    print("stress (8 threads, 20% writes): {} errors, file {}".format(
+        len(errors), "consistent" if check_file() else "INCONSISTENT"))
+    for error in errors:
+        print("  {!r}".format(error))
+
+    for write_ratio in (0.0, 0.01):
+        for threads in (1, 2, 4, 8):
+            rate, errors = run(threads, seconds, ids, write_ratio)
+            print("{:>3.0%} writes, {} threads: {:>9.0f} ops/s{}".format(
+                write_ratio, threads, rate,
+                " ({} errors)".format(len(errors)) if errors else ""))
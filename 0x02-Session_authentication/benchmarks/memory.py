@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Memory benchmark: bytes per User, __dict__ vs __slots__
+
+Usage (from the project directory):
+    python3 -m benchmarks.memory [count]
+"""
+from datetime import datetime
+import sys
+import tracemalloc
+import uuid
+from models.base import TIMESTAMP_FORMAT
+from models.user import User
+
+
+class DictUser():
+    """ User as it was stored before __slots__: a per-instance __dict__
+    with datetime timestamps
+    """
+
+    def __init__(self, **kwargs: dict):
+        """ Same attributes as User
+        """
+        self.id = kwargs.get('id')
+        self.created_at = datetime.strptime(kwargs.get('created_at'),
+                                            TIMESTAMP_FORMAT)
+        self.updated_at = datetime.strptime(kwargs.get('updated_at'),
+                                            TIMESTAMP_FORMAT)
+        self.email = kwargs.get('email')
+        self._password = kwargs.get('_password')
+        self.first_name = kwargs.get('first_name')
+        self.last_name = kwargs.get('last_name')
+
+
+def sample(count: int) -> list:
+    """ Serialized users, as read from .db_User.json
+    """
+    now = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    return [{
+        'id': str(uuid.uuid4()),
+        'created_at': now,
+        'updated_at': now,
+        'email': 'user{}@example.com'.format(i),
+        '_password': uuid.uuid4().hex * 2,
+        'first_name': 'First{}'.format(i),
+        'last_name': 'Last{}'.format(i),
+    } for i in range(count)]
+
+
+def bytes_per_object(cls, records: list) -> float:
+    """ Bytes allocated per instance built from records
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objs = [cls(**record) for record in records]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'lineno'))
+    # The list holding the objects is not part of the representation
+    size -= sys.getsizeof(objs)
+    return size / len(objs)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    records = sample(count)
+    before = bytes_per_object(DictUser, records)
+    after = bytes_per_object(User, records)
+    print("users: {}".format(count))
+    print("__dict__ User: {:.1f} bytes/user".format(before))
+    print("__slots__ User: {:.1f} bytes/user".format(after))
+    print("saved: {:.1f}%".format(100 * (before - after) / before))
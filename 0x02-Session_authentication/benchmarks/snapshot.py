@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Save latency and consistency of full scans running concurrently
+
+A writer saves and removes users two at a time (bulk_save/bulk_remove)
+while reader threads scan the whole store: every scan must see both
+users of a pair or none.
+
+Usage (writes .db_User.json in the current directory):
+    PYTHONPATH=<project directory> python3 -m benchmarks.snapshot \
+        [users] [seconds]
+"""
+import sys
+import threading
+import time
+from models.user import User
+
+
+def writer(stop: threading.Event, latencies: list):
+    """ Save then remove pairs of users until stop is set
+    """
+    i = 0
+    while not stop.is_set():
+        pair = [User(email='pair{}@example.com'.format(i + k))
+                for k in range(2)]
+        start = time.perf_counter()
+        User.bulk_save(pair)
+        latencies.append(time.perf_counter() - start)
+        User.bulk_remove(user.id for user in pair)
+        i += 2
+
+
+def reader(stop: threading.Event, scans: list, torn: list):
+    """ Count the users of pairs in full scans until stop is set
+    """
+    while not stop.is_set():
+        pairs = sum(1 for user in User.scan()
+                    if user.email.startswith('pair'))
+        scans.append(pairs)
+        if pairs % 2:
+            torn.append(pairs)
+
+
+def run(readers: int, seconds: float) -> tuple:
+    """ (scans/s, median and max save latency, torn scans) with
+    `readers` scanning threads
+    """
+    stop = threading.Event()
+    latencies, scans, torn = [], [], []
+    threads = [threading.Thread(target=writer, args=(stop, latencies))]
+    threads += [threading.Thread(target=reader, args=(stop, scans, torn))
+                for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return (len(scans) / seconds, latencies[len(latencies) // 2],
+            latencies[-1], len(torn))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    User.load_from_file()
+    User.bulk_save(User(email='user{}@example.com'.format(i))
+                   for i in range(count - User.count()))
+    for user in User.scan():
+        pass
+    for readers in (0, 1, 2, 4):
+        rate, median, worst, torn = run(readers, seconds)
+        print("{} readers: {:>6.1f} scans/s, save {:.2f} ms median, "
+              "{:.2f} ms max, {} torn scans".format(
+                  readers, rate, median * 1000, worst * 1000, torn))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Startup time of the JSON engine: JSON files vs binary snapshot
+
+For each size, synthetic users are written to .db_User.json in a
+temporary directory, then fresh processes time User.load_from_file():
+- json: snapshots off (default), the files are parsed
+- cold: STORAGE_SNAPSHOT=1 without snapshot, the files are parsed
+- warm: the snapshot written at the journal rotation of a save is read
+- stale: the journal was removed, the files are parsed
+
+Usage (from the project directory):
+    python3 -m benchmarks.startup [sizes ...]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from benchmarks.memory import sample
+
+
+SIZES = (10000, 100000, 1000000)
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_seconds(directory: str, *args: str) -> float:
+    """ Duration of User.load_from_file() in a fresh process with
+    snapshots on (then a save rotating the journal with '--save')
+    """
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup', '--child'] +
+        list(args), cwd=directory,
+        env=dict(os.environ, PYTHONPATH=PROJECT, STORAGE_SNAPSHOT='1'),
+        check=True, stdout=subprocess.PIPE)
+    return float(output.stdout)
+
+
+def run(count: int) -> dict:
+    """ Load times (s) of `count` users in each case
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, '.db_User.json')
+        records = {record['id']: record for record in sample(count)}
+        with open(file_path, 'w') as f:
+            json.dump(records, f)
+        result = {'json': load_seconds(directory, '--json')}
+        result['cold'] = load_seconds(directory, '--save')
+        result['warm'] = load_seconds(directory)
+        os.remove(os.path.join(directory, '.db_User.journal'))
+        result['stale'] = load_seconds(directory)
+        result['snapshot_mb'] = os.path.getsize(
+            os.path.join(directory, '.db_User.snapshot')) / 1e6
+        return result
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--child']:
+        if '--json' in sys.argv:
+            os.environ['STORAGE_SNAPSHOT'] = '0'
+        if '--save' in sys.argv:
+            os.environ['STORAGE_JOURNAL_MAX_BYTES'] = '0'
+        from models.user import User
+        User.load_from_file()
+        print(User.metrics()['load_seconds'])
+        if '--save' in sys.argv:
+            # The snapshot thread is waited for on exit
+            User.query().first().save()
+        sys.exit(0)
+    print("{:>8} {:>8} {:>8} {:>8} {:>8} {:>12}".format(
+        "users", "json s", "cold s", "warm s", "stale s", "snapshot MB"))
+    for count in [int(arg) for arg in sys.argv[1:]] or SIZES:
+        result = run(count)
+        print("{:>8} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>12.1f}".format(
+            count, result['json'], result['cold'], result['warm'],
+            result['stale'], result['snapshot_mb']))
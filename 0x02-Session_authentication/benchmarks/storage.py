@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+""" Storage benchmark of models.base + models.user at several sizes
+
+For each size, synthetic users are written to .db_User.json in a
+temporary directory, then a fresh process (honouring STORAGE_ENGINE,
+STORAGE_SHARDS, STORAGE_CACHE_* ...) measures load_from_file (time and
+peak RSS), get, search({'email'}), all() + to_json, save() latencies and
+save_to_file (time and bytes written). Results are printed as JSON.
+
+Usage (from the project directory):
+    python3 -m benchmarks.storage [--saves N] [--output FILE] [sizes ...]
+"""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.memory import sample
+
+
+SIZES = (10000, 100000, 1000000)
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(samples: list) -> dict:
+    """ Mean, p50, p90, p99 and max of durations (s), in microseconds
+    """
+    samples = sorted(samples)
+
+    def at(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {key: round(value * 1e6, 1) for key, value in (
+        ('mean', sum(samples) / len(samples)), ('p50', at(0.5)),
+        ('p90', at(0.9)), ('p99', at(0.99)), ('max', samples[-1]))}
+
+
+def timed(function, *args: list) -> float:
+    """ Duration (s) of one call
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def bytes_written() -> int:
+    """ Bytes this process wrote so far, None if unknown
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def measure(count: int, saves: int) -> dict:
+    """ Measures on the store of the current directory (child process)
+    """
+    from models.user import User
+    result = {'users': count,
+              'engine': os.getenv('STORAGE_ENGINE', 'json')}
+    result['load_s'] = round(timed(User.load_from_file), 4)
+    result['load_peak_rss_kb'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rand = random.Random(0)
+    indexes = [rand.randrange(count) for _ in range(1000)]
+    ids = {}
+    for user in User.scan():
+        ids[user.email] = user.id
+    emails = ['user{}@example.com'.format(i) for i in indexes]
+    result['get_us'] = percentiles([timed(User.get, ids[email])
+                                    for email in emails])
+    result['search_email_us'] = percentiles([
+        timed(User.search, {'email': email}) for email in emails[:100]])
+    start = time.perf_counter()
+    dumped = [user.to_json() for user in User.all()]
+    result['all_to_json_s'] = round(time.perf_counter() - start, 4)
+    del dumped
+    latencies = []
+    for email in emails[:saves]:
+        user = User.get(ids[email])
+        user.last_name = 'Saved'
+        latencies.append(timed(user.save))
+    result['save_us'] = percentiles(latencies)
+    before = bytes_written()
+    result['save_to_file_s'] = round(timed(User.save_to_file), 4)
+    after = bytes_written()
+    result['save_to_file_bytes'] = None if before is None else after - before
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run(count: int, saves: int) -> dict:
+    """ Generate `count` users in a temporary directory and measure them
+    in a fresh process
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        records = sample(count)
+        with open(os.path.join(directory, '.db_User.json'), 'w') as f:
+            json.dump({record['id']: record for record in records}, f)
+        del records
+        env = dict(os.environ, PYTHONPATH=PROJECT)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.storage', '--child',
+             str(count), str(saves)],
+            cwd=directory, env=env, check=True, stdout=subprocess.PIPE)
+        return json.loads(output.stdout)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['--child']:
+        print(json.dumps(measure(int(args[1]), int(args[2]))))
+        sys.exit(0)
+    saves = 20
+    output = None
+    sizes = []
+    while args:
+        arg = args.pop(0)
+        if arg == '--saves':
+            saves = int(args.pop(0))
+        elif arg == '--output':
+            output = args.pop(0)
+        else:
+            sizes.append(int(arg))
+    results = [run(count, saves) for count in sizes or SIZES]
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" Aggregates module: counters maintained as objects change
+"""
+from typing import Callable, Dict, List
+
+
+class Aggregates():
+    """ Number of objects by group, for each metric of a class
+
+    A metric maps the serialized dict of an object to its group (None:
+    not counted). The groups of each object are remembered, so a change
+    or a removal adjusts the counters without looking at other objects.
+    """
+
+    def __init__(self, metrics: Dict[str, Callable]):
+        """ Initialize empty counters of metrics (name -> function)
+        """
+        self.metrics = metrics
+        self.counts = {name: {} for name in metrics}
+        self._groups = {}
+
+    def add(self, obj_id: str, data: dict):
+        """ Count an object (again, if its groups changed)
+        """
+        self.remove(obj_id)
+        groups = tuple(metric(data) for metric in self.metrics.values())
+        self._groups[obj_id] = groups
+        for name, group in zip(self.metrics, groups):
+            if group is not None:
+                counts = self.counts[name]
+                counts[group] = counts.get(group, 0) + 1
+
+    def remove(self, obj_id: str):
+        """ Stop counting an object
+        """
+        groups = self._groups.pop(obj_id, None)
+        if groups is None:
+            return
+        for name, group in zip(self.metrics, groups):
+            if group is not None:
+                counts = self.counts[name]
+                counts[group] -= 1
+                if counts[group] == 0:
+                    del counts[group]
+
+
+def changes(metrics: Dict[str, Callable], old: dict,
+            new: dict) -> List[tuple]:
+    """ (metric name, group, +1 or -1) adjustments of the counters when
+    the serialized dict of an object goes from old to new (None: absent)
+    """
+    result = []
+    for name, metric in metrics.items():
+        before = None if old is None else metric(old)
+        after = None if new is None else metric(new)
+        if before == after:
+            continue
+        if before is not None:
+            result.append((name, before, -1))
+        if after is not None:
+            result.append((name, after, 1))
+    return result
+
+
+def apply(counts: Dict[str, dict], deltas: List[tuple]):
+    """ Adjust counters (metric name -> group -> count) by deltas
+    """
+    for name, group, delta in deltas:
+        groups = counts.setdefault(name, {})
+        groups[group] = groups.get(group, 0) + delta
+        if groups[group] == 0:
+            del groups[group]
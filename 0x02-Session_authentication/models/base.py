@@ -1,39 +1,121 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from calendar import timegm
+from datetime import datetime, timedelta
+from typing import TypeVar, List, Iterable, Iterator
+from models.changes import FEED
+from models.codec import TIMESTAMP_FORMAT, Codec, codec_for, \
+    decode_timestamp
+from models.columns import Columns
+from models.engines import StorageEngine, engine_for
+from models.engines.engine import cursor_of
+from models.query import Query
+from models.engines.json_file import DATA
+from models.ids import new_id
+from models.metrics import METRICS
 import json
-import uuid
+import time
 
 
-TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
-DATA = {}
+EPOCH = datetime(1970, 1, 1)
+_FIELDS = {}
+_TRANSIENT = ('_fragment',)
+
+
+class VersionConflict(Exception):
+    """ Raised by a compare-and-set save/remove when the stored object
+    doesn't have the expected version
+    """
+
+
+def to_timestamp(value: datetime) -> int:
+    """ Convert a (naive UTC or aware) datetime to epoch seconds
+    """
+    return timegm(value.utctimetuple())
+
+
+def from_timestamp(value: int) -> datetime:
+    """ Convert epoch seconds to a naive UTC datetime
+    """
+    return EPOCH + timedelta(seconds=value)
 
 
 class Base():
     """ Base class
+
+    Attributes are stored in __slots__ (timestamps as epoch seconds) so
+    instances don't carry a per-instance __dict__. `_fragment` caches the
+    serialized JSON of the object with the values it was encoded from.
+    Saves and removals are published on models.changes.FEED.
+
+    Load, save and search costs are recorded in models.metrics.METRICS
+    (see metrics()).
+
+    `version` counts the saves of the object (0 before the first one),
+    set by the storage engine from the stored version when writing:
+    save(version=N) and remove(version=N) are compare-and-set operations
+    that only apply while the stored object is still at version N, so
+    concurrent editors detect lost updates without holding any lock.
     """
+    __slots__ = ('id', '_created_at', '_updated_at', 'version', '_fragment')
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
-        s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
-
-        self.id = kwargs.get('id', str(uuid.uuid4()))
+        self.id = kwargs['id'] if 'id' in kwargs else new_id()
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self._created_at = decode_timestamp(kwargs.get('created_at'))
         else:
-            self.created_at = datetime.utcnow()
+            self._created_at = int(time.time())
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self._updated_at = decode_timestamp(kwargs.get('updated_at'))
         else:
-            self.updated_at = datetime.utcnow()
+            self._updated_at = int(time.time())
+        self.version = kwargs.get('version') or 0
+
+    @property
+    def created_at(self) -> datetime:
+        """ Getter of the creation date
+        """
+        return from_timestamp(self._created_at)
+
+    @created_at.setter
+    def created_at(self, value: datetime):
+        """ Setter of the creation date
+        """
+        self._created_at = to_timestamp(value)
+
+    @property
+    def updated_at(self) -> datetime:
+        """ Getter of the last update date
+        """
+        return from_timestamp(self._updated_at)
+
+    @updated_at.setter
+    def updated_at(self, value: datetime):
+        """ Setter of the last update date
+        """
+        self._updated_at = to_timestamp(value)
+
+    @classmethod
+    def fields(cls) -> tuple:
+        """ Slotted attribute names, from Base down to cls
+        """
+        fields = _FIELDS.get(cls)
+        if fields is None:
+            fields = tuple(name
+                           for klass in reversed(cls.__mro__)
+                           for name in klass.__dict__.get('__slots__', ())
+                           if name not in _TRANSIENT)
+            _FIELDS[cls] = fields
+        return fields
+
+    @classmethod
+    def codec(cls) -> Codec:
+        """ Precompiled serializer/deserializer of the class
+        """
+        return codec_for(cls)
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -47,66 +129,146 @@ class Base():
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
-                result[key] = value
-        return result
+        codec = codec_for(self.__class__)
+        if for_serialization:
+            return codec.dump(self)
+        return codec.public(self)
+
+    def fragment(self) -> str:
+        """ Serialized JSON of the object, encoded again only when its
+        attributes changed since the last call
+        """
+        codec = codec_for(self.__class__)
+        if codec.values is None:
+            return json.dumps(codec.dump(self))
+        try:
+            values = codec.values(self)
+        except AttributeError:
+            # Some slot is unset
+            return json.dumps(codec.dump(self))
+        cached = getattr(self, '_fragment', None)
+        if cached is None or cached[0] != values:
+            cached = (values, json.dumps(codec.dump(self)))
+            self._fragment = cached
+        return cached[1]
+
+    def copy(self) -> TypeVar('Base'):
+        """ Detached copy of the object (same ID and version), to edit
+        without touching the stored instance
+        """
+        codec = codec_for(self.__class__)
+        return codec.load(codec.dump(self))
+
+    @classmethod
+    def engine(cls) -> StorageEngine:
+        """ Storage engine of the class
+        """
+        return engine_for(cls)
 
     @classmethod
     def load_from_file(cls):
         """ Load all objects from file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
-
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        engine = engine_for(cls)
+        start = time.perf_counter()
+        engine.load()
+        METRICS.set(cls.__name__, 'load_seconds', time.perf_counter() - start)
+        METRICS.set(cls.__name__, 'load_objects', engine.count())
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        with METRICS.timer(cls.__name__, 'save_to_file_seconds'):
+            engine_for(cls).persist()
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def metrics(cls) -> dict:
+        """ Store metrics of the class: load_seconds/load_objects of the
+        last load, save_to_file_seconds and write_seconds (save/remove)
+        histograms, bytes_written, searches, search_scanned,
+        search_returned, objects and objects_in_memory
+        """
+        return METRICS.of(cls.__name__)
+
+    @classmethod
+    def refresh(cls) -> int:
+        """ Apply the changes other processes made to the store
+        """
+        return engine_for(cls).refresh()
 
-    def save(self):
-        """ Save current object
+    def save(self, version: int = None):
+        """ Save current object; with `version`, only if the stored object
+        still has this version (VersionConflict otherwise)
         """
-        s_class = self.__class__.__name__
+        updated_at = self._updated_at
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        engine = engine_for(self.__class__)
+        with METRICS.timer(self.__class__.__name__, 'write_seconds'):
+            if version is None:
+                engine.put(self)
+            elif not engine.put_if(self, version):
+                self._updated_at = updated_at
+                raise VersionConflict("{} {} isn't at version {}".format(
+                    self.__class__.__name__, self.id, version))
+        FEED.emit(self.__class__.__name__, self.id, 'save')
+
+    def remove(self, version: int = None):
+        """ Remove object; with `version`, only if the stored object still
+        has this version (VersionConflict otherwise)
+        """
+        engine = engine_for(self.__class__)
+        with METRICS.timer(self.__class__.__name__, 'write_seconds'):
+            if version is None:
+                deleted = engine.delete(self.id)
+            elif engine.delete_if(self.id, version):
+                deleted = True
+            else:
+                raise VersionConflict("{} {} isn't at version {}".format(
+                    self.__class__.__name__, self.id, version))
+        if deleted:
+            FEED.emit(self.__class__.__name__, self.id, 'remove')
+
+    @classmethod
+    def bulk_save(cls, objs: Iterable[TypeVar('Base')],
+                  versions: Iterable[int] = None) -> List[bool]:
+        """ Save several objects, persisted once; with `versions`, each
+        one only if the stored object still has the matching version
+        (None: any version); return whether each one was saved
+        """
+        objs = list(objs)
+        versions = None if versions is None else list(versions)
+        now = datetime.utcnow()
+        updated_at = [obj._updated_at for obj in objs]
+        for obj in objs:
+            obj.updated_at = now
+        with METRICS.timer(cls.__name__, 'write_seconds'):
+            done = engine_for(cls).put_many(objs, versions)
+        for obj, previous, saved in zip(objs, updated_at, done):
+            if saved:
+                FEED.emit(cls.__name__, obj.id, 'save')
+            else:
+                obj._updated_at = previous
+        return done
 
-    def remove(self):
-        """ Remove object
+    @classmethod
+    def bulk_remove(cls, ids: Iterable[str]) -> List[bool]:
+        """ Remove several objects by ID, persisted once; return whether
+        each one existed
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        ids = list(ids)
+        with METRICS.timer(cls.__name__, 'write_seconds'):
+            deleted = engine_for(cls).delete_many(ids)
+        for obj_id, done in zip(ids, deleted):
+            if done:
+                FEED.emit(cls.__name__, obj_id, 'remove')
+        return deleted
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return engine_for(cls).count()
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -114,24 +276,74 @@ class Base():
         """
         return cls.search()
 
+    @classmethod
+    def scan(cls) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects without building a list
+        """
+        return engine_for(cls).scan()
+
+    @classmethod
+    def page(cls, limit: int = None, after: str = None,
+             order_by: str = 'id') -> List[TypeVar('Base')]:
+        """ Return up to `limit` objects following the cursor `after`,
+        ordered by `order_by` ('id' or 'created_at')
+        """
+        return engine_for(cls).page(order_by, after, limit)
+
+    def cursor(self, order_by: str = 'id') -> str:
+        """ Cursor of the page following this object
+        """
+        return cursor_of(self, order_by)
+
+    @classmethod
+    def created_between(cls, start: datetime = None, end: datetime = None,
+                        limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects created from start (included) to end (excluded), by
+        creation date, read from the created_at index
+        """
+        return cls.query().where_range('created_at', start, end) \
+            .order_by('created_at').limit(limit).all()
+
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return engine_for(cls).get(id)
+
+    @classmethod
+    def aggregate(cls, name: str) -> dict:
+        """ Number of objects by group of the metric `name` declared in
+        the class' `_aggregates` dict
+        """
+        return engine_for(cls).aggregate(name)
+
+    @classmethod
+    def columns(cls) -> Columns:
+        """ Columnar copy of the `_columns` of all objects, for
+        histogram/null_count/value_counts aggregates
+        """
+        return engine_for(cls).columns()
+
+    @classmethod
+    def text_search(cls, query: str,
+                    limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects whose `_searchable` attributes have a word starting
+        with each word of query (type-ahead), at most `limit`
+        """
+        return engine_for(cls).text_search(query, limit)
+
+    @classmethod
+    def query(cls) -> Query:
+        """ Lazy query (equality, in, range, prefix, order, limit) on all
+        objects, see Query.explain() for the chosen index
+        """
+        return Query(cls)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        results = engine_for(cls).search(attributes)
+        METRICS.add(cls.__name__, 'searches')
+        METRICS.add(cls.__name__, 'search_returned', len(results))
+        return results
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+""" Change feed module: events of the saved and removed objects
+"""
+from collections import deque, namedtuple
+from typing import Callable
+import threading
+import uuid
+
+
+Change = namedtuple('Change', ('s_class', 'id', 'op', 'version'))
+
+
+class ChangeFeed():
+    """ In-process feed of the changes of stored objects
+
+    Each change gets the next version number and is passed to every
+    subscriber (an exception in one doesn't fail the change nor stop the
+    others). The last `max_events` changes are kept for readers polling
+    with since().
+
+    The feed lives in one process: versions count the changes seen by
+    this worker (its own and those found by refresh()), so they only
+    mean something to the feed with the same `id`.
+    """
+
+    def __init__(self, max_events: int = 10000):
+        """ Initialize an empty feed
+        """
+        self.id = uuid.uuid4().hex
+        self.version = 0
+        self._events = deque(maxlen=max_events)
+        self._subscribers = []
+        self._cond = threading.Condition()
+
+    def subscribe(self, callback: Callable[[Change], None]) -> Callable:
+        """ Call callback(change) for each change, return callback
+        """
+        with self._cond:
+            self._subscribers = self._subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback: Callable[[Change], None]):
+        """ Stop calling callback
+        """
+        with self._cond:
+            self._subscribers = [subscriber
+                                 for subscriber in self._subscribers
+                                 if subscriber is not callback]
+
+    def emit(self, s_class: str, obj_id: str, op: str) -> Change:
+        """ Record a change ('save' or 'remove') and notify subscribers
+        """
+        with self._cond:
+            self.version += 1
+            change = Change(s_class, obj_id, op, self.version)
+            self._events.append(change)
+            self._cond.notify_all()
+            subscribers = self._subscribers
+        for subscriber in subscribers:
+            try:
+                subscriber(change)
+            except Exception:
+                continue
+        return change
+
+    def since(self, version: int, timeout: float = 0) -> tuple:
+        """ (changes after version, True if some were dropped or the
+        version is from a previous run), waiting up to timeout seconds
+        for one
+        """
+        with self._cond:
+            restarted = version > self.version
+            if restarted:
+                version = 0
+            self._cond.wait_for(lambda: self.version > version, timeout)
+            events = list(self._events)
+        truncated = restarted or (
+            len(events) > 0 and events[0].version > version + 1)
+        return [change for change in events
+                if change.version > version], truncated
+
+
+FEED = ChangeFeed()
+
+
+def subscribe(callback: Callable[[Change], None]) -> Callable:
+    """ Call callback(change) for each change of any stored object
+    """
+    return FEED.subscribe(callback)
+
+
+def unsubscribe(callback: Callable[[Change], None]):
+    """ Stop calling callback
+    """
+    FEED.unsubscribe(callback)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+""" Codec module: per-class serializers compiled from the field list
+"""
+from datetime import date, datetime
+from operator import attrgetter
+from typing import Callable
+from models.ids import new_id
+import time
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+TIMESTAMP_FIELDS = ('_created_at', '_updated_at')
+_DAY_SECONDS = 86400
+_EPOCH_DAY = date(1970, 1, 1).toordinal()
+_DAYS_BY_STRING = {}
+_STRINGS_BY_DAY = {}
+
+
+def encode_timestamp(value: int) -> str:
+    """ Epoch seconds to TIMESTAMP_FORMAT ("%Y-%m-%dT%H:%M:%S")
+    """
+    day, seconds = divmod(value, _DAY_SECONDS)
+    prefix = _STRINGS_BY_DAY.get(day)
+    if prefix is None:
+        prefix = date.fromordinal(day + _EPOCH_DAY).isoformat() + 'T'
+        _STRINGS_BY_DAY[day] = prefix
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%s%02d:%02d:%02d' % (prefix, hours, minutes, seconds)
+
+
+def decode_timestamp(value: str) -> int:
+    """ TIMESTAMP_FORMAT to epoch seconds
+    """
+    if len(value) != 19 or value[10] != 'T':
+        # Let datetime report (or accept) anything unusual
+        parsed = datetime.strptime(value, TIMESTAMP_FORMAT)
+        return int((parsed - datetime(1970, 1, 1)).total_seconds())
+    day = _DAYS_BY_STRING.get(value[:10])
+    if day is None:
+        day = (date.fromisoformat(value[:10]).toordinal() -
+               _EPOCH_DAY) * _DAY_SECONDS
+        _DAYS_BY_STRING[value[:10]] = day
+    return (day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 +
+            int(value[17:19]))
+
+
+def _format_value(value):
+    """ JSON value of a __dict__ attribute
+    """
+    if type(value) is datetime:
+        return value.strftime(TIMESTAMP_FORMAT)
+    return value
+
+
+class Codec():
+    """ Serializer and deserializer of one Base subclass
+
+    The functions are generated once from cls.fields(). Slotted classes
+    are decoded straight into their slots without calling __init__, so
+    their __init__ must only copy fields from kwargs (like User does);
+    classes with a __dict__ are still built with cls(**data).
+    """
+
+    def __init__(self, cls: type):
+        """ Compile the codec of cls
+        """
+        self.cls = cls
+        self.fields = cls.fields()
+        self.has_dict = not all('__slots__' in klass.__dict__
+                                for klass in cls.__mro__[:-1])
+        self.dump = self._compile_encoder(True)
+        self.public = self._compile_encoder(False)
+        self.load = self._compile_decoder()
+        # Snapshot of the slotted values, None when a __dict__ may change
+        self.values = None if self.has_dict else attrgetter(*self.fields)
+        # Serialized keys holding the very value of the attribute of the
+        # same name (not timestamps, defaulted or behind a property)
+        self.raw_fields = frozenset() if self.has_dict else frozenset(
+            field for field in self.fields
+            if field not in TIMESTAMP_FIELDS and field != 'version' and
+            not isinstance(getattr(cls, field, None), property))
+
+    @staticmethod
+    def key(field: str) -> str:
+        """ JSON key of a slotted field
+        """
+        return field[1:] if field in TIMESTAMP_FIELDS else field
+
+    def _compile(self, name: str, lines: list, namespace: dict) -> Callable:
+        """ Build the function `name` from its source lines
+        """
+        exec("\n".join(lines), namespace)
+        return namespace[name]
+
+    def _compile_encoder(self, for_serialization: bool) -> Callable:
+        """ Function obj -> dict, all fields or public ones only
+        """
+        items = []
+        for field in self.fields:
+            if field in TIMESTAMP_FIELDS:
+                items.append("{!r}: ts(obj.{})".format(self.key(field),
+                                                       field))
+            elif for_serialization or field[0] != '_':
+                items.append("{!r}: obj.{}".format(field, field))
+        lines = ["def encode(obj):",
+                 "    try:",
+                 "        result = {" + ", ".join(items) + "}",
+                 "    except AttributeError:",
+                 "        return slow(obj)"]
+        if self.has_dict:
+            lines += ["    for key, value in obj.__dict__.items():"]
+            if not for_serialization:
+                lines += ["        if key[0] == '_':",
+                          "            continue"]
+            lines += ["        result[key] = fmt(value)"]
+        lines += ["    return result"]
+        slow = self._slow_encoder(for_serialization)
+        return self._compile("encode", lines, {
+            'ts': encode_timestamp, 'fmt': _format_value, 'slow': slow})
+
+    def _slow_encoder(self, for_serialization: bool) -> Callable:
+        """ Encoder tolerating unset slots (read as None)
+        """
+        fields = self.fields
+
+        def encode(obj):
+            result = {}
+            for field in fields:
+                if field in TIMESTAMP_FIELDS:
+                    result[field[1:]] = encode_timestamp(getattr(obj, field))
+                elif for_serialization or field[0] != '_':
+                    result[field] = getattr(obj, field, None)
+            for key, value in getattr(obj, '__dict__', {}).items():
+                if for_serialization or key[0] != '_':
+                    result[key] = _format_value(value)
+            return result
+        return encode
+
+    def _compile_decoder(self) -> Callable:
+        """ Function dict -> instance
+        """
+        cls = self.cls
+        if self.has_dict:
+            return lambda data: cls(**data)
+        lines = ["def decode(data):",
+                 "    obj = new(cls)",
+                 "    get = data.get"]
+        for field in self.fields:
+            key = self.key(field)
+            if field == 'id':
+                lines += ["    obj.id = get('id') if 'id' in data "
+                          "else new_id()"]
+            elif field == 'version':
+                lines += ["    obj.version = get('version') or 0"]
+            elif field in TIMESTAMP_FIELDS:
+                lines += ["    value = get({!r})".format(key),
+                          "    obj.{} = now() if value is None "
+                          "else ts(value)".format(field)]
+            else:
+                lines += ["    obj.{} = get({!r})".format(field, key)]
+        lines += ["    return obj"]
+        return self._compile("decode", lines, {
+            'new': object.__new__, 'cls': cls, 'new_id': new_id,
+            'ts': decode_timestamp, 'now': lambda: int(time.time())})
+
+
+_CODECS = {}
+
+
+def codec_for(cls: type) -> Codec:
+    """ Codec of cls, compiled on first use
+    """
+    codec = _CODECS.get(cls)
+    if codec is None:
+        codec = Codec(cls)
+        _CODECS[cls] = codec
+    return codec
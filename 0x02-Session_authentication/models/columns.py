@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+""" Columns module: columnar shadow of a store for analytic queries
+"""
+from array import array
+from typing import Callable, Dict, Iterable
+from models.codec import decode_timestamp
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def attribute(name: str) -> Callable:
+    """ Column function: a value of the serialized dict
+    """
+    return lambda data: data.get(name)
+
+
+def epoch(name: str) -> Callable:
+    """ Column function: a serialized timestamp as epoch seconds
+    """
+    return lambda data: decode_timestamp(data[name])
+
+
+class Columns():
+    """ Some values of every object, one contiguous array per column
+
+    Columns are declared as name -> (kind, function of the serialized
+    dict): 'int' columns hold 64-bit integers (epoch timestamps...) and
+    'category' ones are dictionary-encoded (index in the list of their
+    distinct values, -1 for None). A removed object's row is reused by
+    the next insertion, `live` marking the rows in use. The aggregates
+    run on NumPy views of the arrays when NumPy is installed, with plain
+    loops over the arrays otherwise.
+    """
+
+    def __init__(self, specs: Dict[str, tuple]):
+        """ Initialize empty columns
+        """
+        self.specs = specs
+        self.arrays = {name: array('q') for name in specs}
+        self.live = array('b')
+        self.categories = {name: [] for name, (kind, _) in specs.items()
+                           if kind == 'category'}
+        self._codes = {name: {} for name in self.categories}
+        self._rows = {}
+        self._free = []
+
+    def __len__(self) -> int:
+        """ Number of objects
+        """
+        return len(self._rows)
+
+    def put(self, obj_id: str, data: dict):
+        """ Write (or overwrite) the row of an object
+        """
+        row = self._rows.get(obj_id)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+                self.live[row] = 1
+            else:
+                row = len(self.live)
+                self.live.append(1)
+                for values in self.arrays.values():
+                    values.append(0)
+            self._rows[obj_id] = row
+        for name, (kind, function) in self.specs.items():
+            value = function(data)
+            if kind == 'category':
+                value = self._code(name, value)
+            self.arrays[name][row] = value
+
+    def _code(self, name: str, value) -> int:
+        """ Code of a category value, added on first use
+        """
+        if value is None:
+            return -1
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = len(self.categories[name])
+            codes[value] = code
+            self.categories[name].append(value)
+        return code
+
+    def remove(self, obj_id: str):
+        """ Free the row of an object
+        """
+        row = self._rows.pop(obj_id, None)
+        if row is not None:
+            self.live[row] = 0
+            self._free.append(row)
+
+    def copy(self) -> 'Columns':
+        """ Copy of the arrays, for aggregates computed without a lock
+        """
+        columns = Columns(self.specs)
+        columns.arrays = {name: array('q', values)
+                          for name, values in self.arrays.items()}
+        columns.live = array('b', self.live)
+        columns.categories = {name: list(values)
+                              for name, values in self.categories.items()}
+        columns._rows = dict.fromkeys(self._rows)
+        return columns
+
+    def values(self, name: str) -> Iterable[int]:
+        """ Values (codes of a category) of the live rows: a NumPy array
+        if NumPy is installed
+        """
+        if name not in self.arrays:
+            raise ValueError("Unknown column: {}".format(name))
+        if numpy is not None:
+            if len(self.live) == 0:
+                return numpy.zeros(0, dtype=numpy.int64)
+            values = numpy.frombuffer(self.arrays[name], dtype=numpy.int64)
+            return values[numpy.frombuffer(self.live, dtype=numpy.int8) != 0]
+        return [value for value, live in zip(self.arrays[name], self.live)
+                if live]
+
+    def histogram(self, name: str, width: int) -> Dict[int, int]:
+        """ Number of values by bucket [start, start + width) of an int
+        column (e.g. width=3600 on created_at: objects per hour)
+        """
+        values = self.values(name)
+        if numpy is not None:
+            starts, counts = numpy.unique(values // width * width,
+                                          return_counts=True)
+            return dict(zip(starts.tolist(), counts.tolist()))
+        counts = {}
+        for value in values:
+            start = value // width * width
+            counts[start] = counts.get(start, 0) + 1
+        return dict(sorted(counts.items()))
+
+    def null_count(self, name: str) -> int:
+        """ Number of None values of a category column
+        """
+        values = self.values(name)
+        if numpy is not None:
+            return int(numpy.count_nonzero(values == -1))
+        return values.count(-1)
+
+    def value_counts(self, name: str) -> dict:
+        """ Number of objects by value of a category column (None
+        excluded)
+        """
+        values = self.values(name)
+        categories = self.categories.get(name)
+        if categories is None:
+            raise ValueError("Not a category column: {}".format(name))
+        if numpy is not None:
+            counts = numpy.bincount(values[values >= 0],
+                                    minlength=len(categories)).tolist()
+        else:
+            counts = [0] * len(categories)
+            for code in values:
+                if code >= 0:
+                    counts[code] += 1
+        return {value: count for value, count in zip(categories, counts)
+                if count > 0}
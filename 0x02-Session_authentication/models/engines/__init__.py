@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+""" Storage engines of models.base
+
+The engine is chosen per deployment with the STORAGE_ENGINE environment
+variable (default: json). Setting STORAGE_CACHE_MAX_OBJECTS and/or
+STORAGE_CACHE_MAX_BYTES keeps only the most recently used objects in
+memory, over the chosen engine (sqlite or mmap).
+"""
+from importlib import import_module
+from models.engines.engine import StorageEngine
+from models.metrics import METRICS
+import os
+
+
+ENGINES = {
+    'json': 'models.engines.json_file.JSONFileEngine',
+    'sqlite': 'models.engines.sqlite.SQLiteEngine',
+    'mmap': 'models.engines.mmap_hash.MmapHashEngine',
+}
+_ENGINES = {}
+
+
+def engine_class(name: str) -> type:
+    """ Storage engine class registered under name
+    """
+    if name not in ENGINES:
+        raise ValueError("Unknown storage engine: {}".format(name))
+    module_name, class_name = ENGINES[name].rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def engine_for(cls: type) -> StorageEngine:
+    """ Storage engine of cls, created on first use
+    """
+    engine = _ENGINES.get(cls)
+    if engine is None:
+        engine = engine_class(os.getenv('STORAGE_ENGINE', 'json'))(cls)
+        max_objects = int(os.getenv('STORAGE_CACHE_MAX_OBJECTS', '0'))
+        max_bytes = int(os.getenv('STORAGE_CACHE_MAX_BYTES', '0'))
+        if max_objects or max_bytes:
+            from models.engines.cache import CachedEngine
+            engine = CachedEngine(engine, max_objects, max_bytes)
+        set_engine(cls, engine)
+    return engine
+
+
+def set_engine(cls: type, engine: StorageEngine):
+    """ Use engine to store the objects of cls (its object counts are
+    read by models.metrics)
+    """
+    _ENGINES[cls] = engine
+    METRICS.gauge(cls.__name__, 'objects', engine.count)
+    METRICS.gauge(cls.__name__, 'objects_in_memory', engine.memory_count)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+""" Hot/cold object cache engine module
+"""
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, TypeVar
+from models.columns import Columns
+from models.engines.engine import StorageEngine
+import sys
+import threading
+
+
+class CachedEngine(StorageEngine):
+    """ Bounded LRU cache of hydrated objects over a persistent engine
+
+    Only the most recently used objects stay in memory (at most
+    max_objects and/or max_bytes, estimated with sys.getsizeof); misses
+    fall through to the backend. count() is kept in memory. Lookups use
+    the backend's own index when it has one, else a key-only index
+    (values -> ids, no objects) built on first use.
+    """
+
+    def __init__(self, backend: StorageEngine, max_objects: int = 0,
+                 max_bytes: int = 0):
+        """ Initialize the cache over backend (0: no limit)
+        """
+        super().__init__(backend.cls)
+        self.backend = backend
+        self.ordered = backend.ordered
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.fields = backend.cls.fields()
+        self._lock = threading.RLock()
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._count = None
+        self._index = None
+        self._keys = {}
+
+    @property
+    def cached_count(self) -> int:
+        """ Number of objects held in memory
+        """
+        return len(self._cache)
+
+    @property
+    def cached_bytes(self) -> int:
+        """ Estimated memory held by the cached objects
+        """
+        return self._bytes
+
+    def _size(self, obj: TypeVar('Base')) -> int:
+        """ Estimated size of an object and its field values
+        """
+        return sys.getsizeof(obj) + sum(
+            sys.getsizeof(getattr(obj, field, None)) for field in self.fields)
+
+    def _cache_put(self, obj: TypeVar('Base')):
+        """ Make obj the most recently used, evicting the coldest ones
+        """
+        with self._lock:
+            self._cache_pop(obj.id)
+            size = self._size(obj)
+            self._cache[obj.id] = obj
+            self._sizes[obj.id] = size
+            self._bytes += size
+            while len(self._cache) > 1 and (
+                    (self.max_objects and
+                     len(self._cache) > self.max_objects) or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                obj_id, _ = self._cache.popitem(last=False)
+                self._bytes -= self._sizes.pop(obj_id)
+
+    def _cache_pop(self, obj_id: str):
+        """ Drop an object from the cache
+        """
+        with self._lock:
+            if self._cache.pop(obj_id, None) is not None:
+                self._bytes -= self._sizes.pop(obj_id)
+
+    def _cached(self, obj: TypeVar('Base')) -> TypeVar('Base'):
+        """ The cached instance of obj if any, else obj
+        """
+        return self._cache.get(obj.id, obj)
+
+    def _native_index(self) -> bool:
+        """ True if the backend answers lookups without a scan
+        """
+        return type(self.backend).lookup is not StorageEngine.lookup
+
+    def _index_add(self, obj_id: str, keys: tuple):
+        """ Add obj_id to the key-only index
+        """
+        self._keys[obj_id] = keys
+        for attribute, value in zip(self.indexed, keys):
+            try:
+                self._index[attribute].setdefault(value, set()).add(obj_id)
+            except TypeError:
+                continue
+
+    def _index_remove(self, obj_id: str):
+        """ Remove obj_id from the key-only index
+        """
+        keys = self._keys.pop(obj_id, None)
+        for attribute, value in zip(self.indexed, keys or ()):
+            try:
+                self._index[attribute].get(value, set()).discard(obj_id)
+            except TypeError:
+                continue
+
+    def _build_index(self):
+        """ Build the key-only index with one scan of the backend
+        """
+        with self._lock:
+            if self._index is not None:
+                return
+            self._index = {attribute: {} for attribute in self.indexed}
+            self._keys = {}
+            for obj in self.backend.scan():
+                self._index_add(obj.id, tuple(
+                    getattr(obj, attribute, None)
+                    for attribute in self.indexed))
+
+    def load(self):
+        """ Open the backend, count its objects and empty the cache
+        """
+        self.backend.load()
+        with self._lock:
+            self._cache.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            self._index = None
+            self._count = self.backend.count()
+
+    def persist(self):
+        """ Persist the backend
+        """
+        self.backend.persist()
+
+    def refresh(self) -> int:
+        """ Apply the backend's external changes: any other process' write
+        drops the cache, the count and the key-only index
+        """
+        changes = self.backend.refresh()
+        if changes:
+            self.load()
+        return changes
+
+    def get(self, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID, from memory when hot
+        """
+        with self._lock:
+            obj = self._cache.get(obj_id)
+            if obj is not None:
+                self._cache.move_to_end(obj_id)
+                return obj
+        obj = self.backend.get(obj_id)
+        if obj is not None:
+            self._cache_put(obj)
+        return obj
+
+    def put(self, obj: TypeVar('Base')):
+        """ Write through to the backend and cache the object
+        """
+        with self._lock:
+            is_new = obj.id not in self._cache and \
+                not self.backend.contains(obj.id)
+            self.backend.put(obj)
+            self._cache_put(obj)
+            if self._count is not None and is_new:
+                self._count += 1
+            if self._index is not None:
+                self._index_remove(obj.id)
+                self._index_add(obj.id, tuple(
+                    getattr(obj, attribute, None)
+                    for attribute in self.indexed))
+
+    def delete(self, obj_id: str) -> bool:
+        """ Delete from the backend and the cache
+        """
+        with self._lock:
+            self._cache_pop(obj_id)
+            deleted = self.backend.delete(obj_id)
+            if deleted and self._count is not None:
+                self._count -= 1
+            if deleted and self._index is not None:
+                self._index_remove(obj_id)
+            return deleted
+
+    def put_if(self, obj: TypeVar('Base'), version: int) -> bool:
+        """ Compare-and-set on the backend, caching the object if done and
+        dropping the (stale) cached one otherwise
+        """
+        with self._lock:
+            if not self.backend.put_if(obj, version):
+                self._cache_pop(obj.id)
+                return False
+            self._cache_put(obj)
+            if self._index is not None:
+                self._index_remove(obj.id)
+                self._index_add(obj.id, tuple(
+                    getattr(obj, attribute, None)
+                    for attribute in self.indexed))
+            return True
+
+    def delete_if(self, obj_id: str, version: int) -> bool:
+        """ Compare-and-delete on the backend and drop the cached object
+        """
+        with self._lock:
+            self._cache_pop(obj_id)
+            deleted = self.backend.delete_if(obj_id, version)
+            if deleted and self._count is not None:
+                self._count -= 1
+            if deleted and self._index is not None:
+                self._index_remove(obj_id)
+            return deleted
+
+    def put_many(self, objs: List[TypeVar('Base')],
+                 versions: List[int] = None) -> List[bool]:
+        """ Write several objects through to the backend at once, dropping
+        the (stale) cached ones of those not stored
+        """
+        with self._lock:
+            new = {obj.id for obj in objs
+                   if obj.id not in self._cache and
+                   not self.backend.contains(obj.id)}
+            done = self.backend.put_many(objs, versions)
+            for obj, ok in zip(objs, done):
+                if not ok:
+                    self._cache_pop(obj.id)
+                    new.discard(obj.id)
+                    continue
+                self._cache_put(obj)
+                if self._index is not None:
+                    self._index_remove(obj.id)
+                    self._index_add(obj.id, tuple(
+                        getattr(obj, attribute, None)
+                        for attribute in self.indexed))
+            if self._count is not None:
+                self._count += len(new)
+            return done
+
+    def delete_many(self, obj_ids: List[str]) -> List[bool]:
+        """ Delete several objects from the backend and the cache
+        """
+        with self._lock:
+            for obj_id in obj_ids:
+                self._cache_pop(obj_id)
+            deleted = self.backend.delete_many(obj_ids)
+            for obj_id, done in zip(obj_ids, deleted):
+                if done and self._count is not None:
+                    self._count -= 1
+                if done and self._index is not None:
+                    self._index_remove(obj_id)
+            return deleted
+
+    def scan(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects without filling the cache
+        """
+        for obj in self.backend.scan():
+            yield self._cached(obj)
+
+    def count(self) -> int:
+        """ Number of objects, O(1)
+        """
+        if self._count is None:
+            self._count = self.backend.count()
+        return self._count
+
+    def memory_count(self) -> int:
+        """ Number of cached objects
+        """
+        return len(self._cache)
+
+    def lookup(self, attribute: str,
+               value) -> Iterable[TypeVar('Base')]:
+        """ Candidate objects whose `attribute` is `value`, hot or not
+        """
+        if attribute not in self.indexed:
+            return self.scan()
+        if self._native_index():
+            return [self._cached(obj)
+                    for obj in self.backend.lookup(attribute, value)]
+        self._build_index()
+        try:
+            ids = list(self._index[attribute].get(value, ()))
+        except TypeError:
+            return self.scan()
+        return [obj for obj in map(self.get, ids) if obj is not None]
+
+    def aggregate(self, name: str) -> dict:
+        """ Number of objects by group of the metric `name`, from the
+        backend
+        """
+        return self.backend.aggregate(name)
+
+    def columns(self) -> Columns:
+        """ Columnar copy of the objects, from the backend
+        """
+        return self.backend.columns()
+
+    def text_search(self, query: str,
+                    limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects matching query, from the backend
+        """
+        return [self._cached(obj)
+                for obj in self.backend.text_search(query, limit)]
+
+    def page(self, order_by: str = 'id', after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Up to `limit` objects following the cursor `after`
+        """
+        return [self._cached(obj)
+                for obj in self.backend.page(order_by, after, limit)]
+
+    def search(self, attributes: dict) -> List[TypeVar('Base')]:
+        """ All objects with matching attributes
+        """
+        if any(attribute in attributes for attribute in self.indexed):
+            return super().search(attributes)
+        return [self._cached(obj)
+                for obj in self.backend.search(attributes)]
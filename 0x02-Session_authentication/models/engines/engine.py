@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+""" Storage engine module
+"""
+from calendar import timegm
+from datetime import datetime
+from typing import Iterable, Iterator, List, TypeVar
+from models.columns import Columns
+from models.metrics import METRICS
+from models.text_index import WORD, match, words_of
+
+
+ORDERS = ('id', 'created_at')
+
+
+def order_key(obj: TypeVar('Base'), order_by: str) -> tuple:
+    """ Sort key of an object in the order `order_by`
+    """
+    if order_by == 'created_at':
+        return (obj._created_at, obj.id)
+    return (obj.id,)
+
+
+def cursor_of(obj: TypeVar('Base'), order_by: str) -> str:
+    """ Cursor pointing right after obj in the order `order_by`
+    """
+    return ":".join(str(part) for part in order_key(obj, order_by))
+
+
+def cursor_key(cursor: str, order_by: str) -> tuple:
+    """ Sort key of a cursor, ValueError if it is malformed
+    """
+    if order_by not in ORDERS:
+        raise ValueError("Unknown order: {}".format(order_by))
+    if order_by == 'created_at':
+        created_at, obj_id = cursor.split(':', 1)
+        return (int(created_at), obj_id)
+    return (cursor,)
+
+
+def timestamp_range(low: datetime, high: datetime) -> tuple:
+    """ (low, high) epoch seconds of the whole seconds holding the
+    datetimes from low (included) to high (excluded), None for an open
+    bound; None if a bound isn't a datetime
+    """
+    if not all(value is None or type(value) is datetime
+               for value in (low, high)):
+        return None
+    if low is not None:
+        low = timegm(low.utctimetuple())
+    if high is not None:
+        high = timegm(high.utctimetuple()) + (high.microsecond > 0)
+    return low, high
+
+
+def version_of(value) -> int:
+    """ Version of a stored object or of its serialized dict, None if
+    missing (0 for objects saved before versions existed)
+    """
+    if value is None:
+        return None
+    if type(value) is dict:
+        return value.get('version') or 0
+    return getattr(value, 'version', None) or 0
+
+
+class StorageEngine():
+    """ Storage of the objects of one Base subclass
+
+    Base.get/search/all/count/save/remove delegate to the engine of their
+    class. Attributes listed in the class' `_indexed` tuple may be served
+    by lookup() instead of a full scan, the metrics of its `_aggregates`
+    dict (see models.aggregates) by aggregate(), the words of its
+    `_searchable` attributes (see models.text_index) by text_search()
+    and its `_columns` (see models.columns) by columns().
+
+    Engines keeping sorted keys of the ORDERS set `ordered`, so page()
+    doesn't sort a whole scan and queries may read them page by page.
+    """
+
+    ordered = False
+
+    def __init__(self, cls: type):
+        """ Initialize the engine of cls
+        """
+        self.cls = cls
+        self.s_class = cls.__name__
+        self.indexed = tuple(getattr(cls, '_indexed', ()))
+        self.metrics = dict(getattr(cls, '_aggregates', {}))
+        self.searchable = tuple(getattr(cls, '_searchable', ()))
+        self.column_specs = dict(getattr(cls, '_columns', {}))
+
+    def load(self):
+        """ Load the persisted objects
+        """
+
+    def persist(self):
+        """ Persist all objects
+        """
+
+    def refresh(self) -> int:
+        """ Apply the changes made by other processes, return their number
+        """
+        return 0
+
+    def get(self, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID, None if missing
+        """
+        raise NotImplementedError
+
+    def contains(self, obj_id: str) -> bool:
+        """ True if an object has this ID
+        """
+        return self.get(obj_id) is not None
+
+    def put(self, obj: TypeVar('Base')):
+        """ Insert or replace an object as the stored version + 1 (set on
+        obj by the engine, never taken from it)
+        """
+        raise NotImplementedError
+
+    def delete(self, obj_id: str) -> bool:
+        """ Remove an object, False if it didn't exist
+        """
+        raise NotImplementedError
+
+    def put_if(self, obj: TypeVar('Base'), version: int) -> bool:
+        """ Replace an object, as version + 1, only if the stored one has
+        this version (compare-and-set); False (obj unchanged) otherwise
+
+        Engines make the comparison and the write atomic.
+        """
+        if version_of(self.get(obj.id)) != version:
+            return False
+        self.put(obj)
+        return True
+
+    def delete_if(self, obj_id: str, version: int) -> bool:
+        """ Remove an object only if the stored one has this version
+        """
+        if version_of(self.get(obj_id)) != version:
+            return False
+        return self.delete(obj_id)
+
+    def put_many(self, objs: List[TypeVar('Base')],
+                 versions: List[int] = None) -> List[bool]:
+        """ Insert or replace several objects, each one as its stored
+        version + 1, only where the stored version is the matching item
+        of `versions` (None: any version); whether each one was stored
+        """
+        done = []
+        for obj, version in zip(objs, versions or [None] * len(objs)):
+            if version is None:
+                self.put(obj)
+                done.append(True)
+            else:
+                done.append(self.put_if(obj, version))
+        return done
+
+    def delete_many(self, obj_ids: List[str]) -> List[bool]:
+        """ Remove several objects, whether each one existed
+        """
+        return [self.delete(obj_id) for obj_id in obj_ids]
+
+    def scan(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects
+        """
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """ Number of objects
+        """
+        return sum(1 for _ in self.scan())
+
+    def memory_count(self) -> int:
+        """ Number of objects held in memory
+        """
+        return 0
+
+    def lookup(self, attribute: str,
+               value) -> Iterable[TypeVar('Base')]:
+        """ Candidate objects whose `attribute` is `value`
+
+        Engines with an index on `attribute` return only its entries;
+        callers still check the candidates.
+        """
+        return self.scan()
+
+    def estimate(self, predicate: TypeVar('Predicate')) -> int:
+        """ Number of candidates an index gives for predicate, None if
+        no index serves it (see models.query)
+        """
+        if predicate.op not in ('eq', 'in'):
+            return None
+        if predicate.attribute == 'id' or (
+                predicate.attribute in self.indexed and
+                type(self).lookup is not StorageEngine.lookup):
+            return len(predicate.values())
+        return None
+
+    def candidates(self, predicate: TypeVar('Predicate')
+                   ) -> Iterator[TypeVar('Base')]:
+        """ Objects of the index serving predicate (may not all match);
+        range and prefix candidates come sorted by their attribute
+        """
+        seen = set()
+        for value in predicate.values():
+            if predicate.attribute == 'id':
+                objs = [self.get(value)] if type(value) is str else []
+            else:
+                objs = self.lookup(predicate.attribute, value)
+            for obj in objs:
+                if obj is not None and obj.id not in seen:
+                    seen.add(obj.id)
+                    yield obj
+
+    def page(self, order_by: str = 'id', after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Up to `limit` objects following the cursor `after` in the
+        order `order_by` (keyset pagination)
+        """
+        if order_by not in ORDERS:
+            raise ValueError("Unknown order: {}".format(order_by))
+        start = None if after is None else cursor_key(after, order_by)
+        objs = sorted((obj for obj in self.scan()
+                       if start is None or order_key(obj, order_by) > start),
+                      key=lambda obj: order_key(obj, order_by))
+        return objs if limit is None else objs[:limit]
+
+    def aggregate(self, name: str) -> dict:
+        """ Number of objects by group of the metric `name`
+
+        Computed with a scan; engines keeping the counters up to date
+        answer without one.
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            raise ValueError("Unknown aggregate: {}".format(name))
+        dump = self.cls.codec().dump
+        counts = {}
+        for obj in self.scan():
+            group = metric(dump(obj))
+            if group is not None:
+                counts[group] = counts.get(group, 0) + 1
+        return counts
+
+    def columns(self) -> Columns:
+        """ Columnar copy of the objects (built with a scan; engines
+        keeping it up to date don't)
+        """
+        columns = Columns(self.column_specs)
+        dump = self.cls.codec().dump
+        for obj in self.scan():
+            columns.put(obj.id, dump(obj))
+        return columns
+
+    def text_search(self, query: str,
+                    limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects whose searchable attributes have a word starting with
+        each word of query (with a scan; engines with a TextIndex don't)
+        """
+        query_words = WORD.findall(query.lower())
+        if len(query_words) == 0 or limit == 0:
+            return []
+        results = []
+        for obj in self.scan():
+            if match(words_of(getattr(obj, attribute, None)
+                              for attribute in self.searchable),
+                     query_words):
+                results.append(obj)
+                if len(results) == limit:
+                    break
+        return results
+
+    @staticmethod
+    def matches(obj: TypeVar('Base'), attributes: dict) -> bool:
+        """ True if obj has all the attribute values
+        """
+        for k, v in attributes.items():
+            if getattr(obj, k) != v:
+                return False
+        return True
+
+    def search(self, attributes: dict) -> List[TypeVar('Base')]:
+        """ All objects with matching attributes
+        """
+        candidates = None
+        for attribute in self.indexed:
+            if attribute in attributes:
+                candidates = self.lookup(attribute, attributes[attribute])
+                break
+        if candidates is None:
+            candidates = self.scan()
+        return self.filter(candidates, attributes)
+
+    def filter(self, candidates: Iterable[TypeVar('Base')],
+               attributes: dict) -> List[TypeVar('Base')]:
+        """ Candidates with matching attributes, counted as scanned in
+        models.metrics
+        """
+        results = []
+        scanned = 0
+        for obj in candidates:
+            scanned += 1
+            if self.matches(obj, attributes):
+                results.append(obj)
+        METRICS.add(self.s_class, 'search_scanned', scanned)
+        return results
@@ -0,0 +1,1003 @@
+#!/usr/bin/env python3
+""" JSON file storage engine module
+"""
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from os import path
+from typing import Iterable, Iterator, List, TypeVar
+from models.aggregates import Aggregates
+from models.changes import FEED
+from models.codec import decode_timestamp
+from models.columns import Columns
+from models.engines.engine import ORDERS, StorageEngine, cursor_key, \
+    timestamp_range, version_of
+from models.engines.rwlock import RWLock
+from models.metrics import METRICS
+from models.engines.snapshot import Snapshot
+from models.text_index import TextIndex
+import fcntl
+import gc
+import gzip
+import json
+import os
+import pickle
+import threading
+import uuid
+import zlib
+
+
+DATA = {}
+GZIP_MAGIC = b'\x1f\x8b'
+SNAPSHOT_FORMAT = 1
+
+
+def read_json(file_path: str) -> dict:
+    """ Content of a JSON file, plain or gzip-compressed (detected from
+    its first bytes), {} if it doesn't exist
+    """
+    if not path.exists(file_path):
+        return {}
+    with open(file_path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    with (gzip.open if compressed else open)(file_path, 'rt') as f:
+        return json.load(f)
+
+
+def write_json(file_path: str, content):
+    """ Replace a JSON file atomically (written aside, then renamed)
+    """
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, file_path)
+
+
+def write_fragments(file_path: str, fragments: Iterable[tuple],
+                    compresslevel: int = None) -> int:
+    """ Replace a JSON file atomically with the object made of
+    (key, serialized JSON value) pairs, compressed with gzip as it is
+    written if compresslevel is set; return its size
+    """
+    quote = json.encoder.encode_basestring_ascii
+    members = (quote(key) + ": " + fragment for key, fragment in fragments)
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    if compresslevel is None:
+        opened = open(tmp_path, 'w')
+    else:
+        opened = gzip.open(tmp_path, 'wt', compresslevel=compresslevel)
+    with opened as f:
+        f.write("{")
+        separator = ""
+        while True:
+            chunk = ", ".join(islice(members, 10000))
+            if not chunk:
+                break
+            f.write(separator + chunk)
+            separator = ", "
+        f.write("}")
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, file_path)
+    return size
+
+
+def read_snapshot(file_path: str, source: tuple):
+    """ Content of a binary snapshot written from `source`, None if it
+    is missing, written from another source (stale) or unreadable
+
+    The file is unpickled, which can run any code it holds: whoever can
+    write to the working directory can run code in the process.
+    """
+    if not path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'rb') as f:
+            # The header is checked before the (large) content is read
+            if pickle.load(f) != (SNAPSHOT_FORMAT, source):
+                return None
+            return pickle.load(f)
+    except Exception:
+        # Truncated or from another version: the JSON files are read
+        return None
+
+
+def write_snapshot(file_path: str, source: tuple, content):
+    """ Replace a binary snapshot (pickle protocol 5) atomically
+    """
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((SNAPSHOT_FORMAT, source), f, protocol=5)
+        pickle.dump(content, f, protocol=5)
+    os.replace(tmp_path, file_path)
+
+
+@contextmanager
+def gc_paused():
+    """ Disable the cyclic garbage collector in the block: building
+    millions of dicts and sets would trigger it over and over
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class JSONFileEngine(StorageEngine):
+    """ Objects held in DATA and saved to .db_<class>.json
+
+    Loaded objects stay serialized in DATA until their first access.
+    Saves write the cached JSON fragment of each object (Base.fragment(),
+    or of its loaded dict), so only changed objects are encoded again.
+    Indexed attributes are kept in a hash index of their saved values,
+    and sorted keys of each order are built on the first page() call, as
+    are the aggregate counters on the first aggregate() call, the
+    TextIndex on the first text_search() call and the Columns on the
+    first columns() call.
+
+    Each change publishes a new immutable Snapshot of the objects:
+    get/scan/search/count read the current one without any lock, so long
+    scans see a single version and never hold writers back (instances are
+    shared, though: unsaved changes to one are visible to all); building
+    a loaded object only locks to swap it in (see _hydrate). The index
+    and sorted keys are guarded by a readers-writer lock, held
+    exclusively by save/remove only while they change them. Saves to the
+    file are serialized and atomic (written aside, then renamed).
+
+    Writes also append to .db_<class>.journal under a file lock, after
+    applying the other processes' changes. refresh() (called at the start
+    of each request) reads the journal's header line and size when
+    nothing changed and otherwise applies only the new journal lines.
+    The journal is restarted past STORAGE_JOURNAL_MAX_BYTES with the next
+    generation (counted in the lock file, as inodes get reused), which
+    makes other workers reload the file.
+
+    With STORAGE_SHARDS=N (N > 1) the file is split into
+    .db_<class>.<k>.json by hash of the object id: a save rewrites only
+    its shard, and the shards are loaded in parallel on a thread pool (or
+    a process pool with STORAGE_LOAD_EXECUTOR=process).
+
+    STORAGE_COMPRESSION=gzip writes the files gzip-compressed (level
+    STORAGE_COMPRESSION_LEVEL, default 1); plain and compressed files
+    are both read whatever the setting, so switching needs no migration.
+
+    With STORAGE_SNAPSHOT=1, each journal rotation (when the files hold
+    every change) also writes .db_<class>.snapshot on a thread, the
+    parsed objects and index pickled with the header line of the new
+    journal (its generation and a random id). A load reads it instead of
+    parsing JSON while the journal has the same header, then replays the
+    journal as usual; saves don't make it stale, only the next rotation
+    does (or a removed journal). Loads never write it, so a missing or
+    stale snapshot costs reading its header on top of the JSON files.
+    Files edited by hand must come with the snapshot removed. The
+    snapshot is unpickled: only enable it in a working directory no one
+    else can write to.
+    """
+
+    ordered = True
+
+    def __init__(self, cls: type):
+        """ Initialize the engine of cls
+        """
+        super().__init__(cls)
+        if DATA.get(self.s_class) is None:
+            DATA[self.s_class] = {}
+        self.file_path = ".db_{}.json".format(self.s_class)
+        self._index = {attribute: {} for attribute in self.indexed}
+        self._keys = {}
+        self._orders = {}
+        self._created = {}
+        self._lock = RWLock()
+        self._mutex = threading.Lock()
+        self._swap = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self.journal_path = ".db_{}.journal".format(self.s_class)
+        self.lock_path = ".db_{}.lock".format(self.s_class)
+        self.journal_max_bytes = int(os.getenv('STORAGE_JOURNAL_MAX_BYTES',
+                                               str(1 << 20)))
+        self._journal = None
+        self._flock_mutex = threading.RLock()
+        self._flock_depth = 0
+        self._flock_fd = None
+        self._flock_pid = None
+        self.shards = max(1, int(os.getenv('STORAGE_SHARDS', '1')))
+        self.compresslevel = None
+        if os.getenv('STORAGE_COMPRESSION') == 'gzip':
+            self.compresslevel = int(os.getenv('STORAGE_COMPRESSION_LEVEL',
+                                               '1'))
+        self._shard_ids = [set() for _ in range(self.shards)]
+        self.manifest_path = ".db_{}.shards.json".format(self.s_class)
+        self.snapshot_path = ".db_{}.snapshot".format(self.s_class)
+        self.binary_snapshot = os.getenv('STORAGE_SNAPSHOT', '0') != '0'
+        self._snapshot_lock = threading.Lock()
+        self._fragments = {}
+        self._aggregates = None
+        self._text = None
+        self._columns = None
+        self._snapshot = Snapshot.of({})
+        self._changes = {}
+
+    @property
+    def objects(self) -> dict:
+        """ Objects (or their serialized dict) by ID
+        """
+        return DATA[self.s_class]
+
+    @contextmanager
+    def _writing(self):
+        """ Hold the lock for writing, then publish the snapshot of the
+        changes made by _store/_unstore
+        """
+        with self._lock.write():
+            try:
+                yield
+            finally:
+                if self._changes:
+                    self._snapshot = self._snapshot.with_changes(
+                        self._changes)
+                    self._changes = {}
+
+    def _hydrate(self, obj_id: str, value,
+                 bucket: dict = None) -> TypeVar('Base'):
+        """ Build the instance of a serialized object and cache it (in
+        the snapshot bucket it was read from and in the current version)
+
+        Only the compare-and-swap of the cached entries takes a lock,
+        `_swap`, which writers hold just as briefly to change DATA: cold
+        reads never wait for the readers-writer lock nor for an index
+        being built.
+        """
+        if type(value) is not dict:
+            return value
+        obj = self.cls.codec().load(value)
+        with self._swap:
+            if bucket is not None:
+                current = bucket.get(obj_id)
+                if current is not None and type(current) is not dict:
+                    # Built meanwhile by another thread
+                    return current
+                bucket[obj_id] = obj
+            latest = self._snapshot.bucket(obj_id)
+            if latest is not bucket and latest.get(obj_id) is value:
+                latest[obj_id] = obj
+            if self.objects.get(obj_id) is value:
+                self.objects[obj_id] = obj
+                cached = self._fragments.pop(obj_id, None)
+                if cached is not None and cached[0] is value and \
+                        self.cls.codec().values is not None:
+                    obj._fragment = (self.cls.codec().values(obj), cached[1])
+        return obj
+
+    def _add_keys(self, obj_id: str, keys: tuple):
+        """ Add obj_id to the index under its indexed values
+        """
+        self._keys[obj_id] = keys
+        for attribute, value in zip(self.indexed, keys):
+            try:
+                self._index[attribute].setdefault(value, set()).add(obj_id)
+            except TypeError:
+                continue
+
+    def _remove_keys(self, obj_id: str):
+        """ Remove obj_id from the index
+        """
+        keys = self._keys.pop(obj_id, None)
+        if keys is None:
+            return
+        for attribute, value in zip(self.indexed, keys):
+            try:
+                ids = self._index[attribute].get(value)
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(obj_id)
+                if len(ids) == 0:
+                    del self._index[attribute][value]
+
+    def _ordered(self, order_by: str) -> list:
+        """ Sorted keys of the saved objects in the order `order_by`
+        """
+        keys = self._orders.get(order_by)
+        if keys is not None:
+            return keys
+        with self._mutex:
+            keys = self._orders.get(order_by)
+            if keys is not None:
+                return keys
+            if order_by == 'created_at':
+                for obj_id, obj in self.objects.items():
+                    if type(obj) is dict:
+                        self._created[obj_id] = decode_timestamp(
+                            obj['created_at'])
+                    else:
+                        self._created[obj_id] = obj._created_at
+                keys = sorted((created_at, obj_id) for obj_id, created_at
+                              in self._created.items())
+            else:
+                keys = sorted((obj_id,) for obj_id in self.objects)
+            self._orders[order_by] = keys
+            return keys
+
+    def _order_remove(self, obj_id: str):
+        """ Remove obj_id from the sorted keys
+        """
+        for order_by, keys in self._orders.items():
+            if order_by == 'created_at':
+                if obj_id not in self._created:
+                    continue
+                key = (self._created.pop(obj_id), obj_id)
+            else:
+                key = (obj_id,)
+            i = bisect_right(keys, key) - 1
+            if i >= 0 and keys[i] == key:
+                del keys[i]
+
+    def _order_add(self, obj_id: str, created_at: int):
+        """ Add an object to the sorted keys
+        """
+        for order_by, keys in self._orders.items():
+            if order_by == 'created_at':
+                self._created[obj_id] = created_at
+                insort(keys, (created_at, obj_id))
+            else:
+                insort(keys, (obj_id,))
+
+    def _store(self, obj_id: str, value):
+        """ Put an object (or its serialized dict) in DATA and the indexes
+        (write lock held)
+        """
+        self._unstore(obj_id)
+        with self._swap:
+            self.objects[obj_id] = value
+        self._changes[obj_id] = value
+        if self.shards > 1:
+            self._shard_ids[self.shard_of(obj_id)].add(obj_id)
+        if type(value) is dict:
+            keys = tuple(value.get(attribute) for attribute in self.indexed)
+            created_at = decode_timestamp(value['created_at'])
+        else:
+            keys = tuple(getattr(value, attribute, None)
+                         for attribute in self.indexed)
+            created_at = value._created_at
+        self._add_keys(obj_id, keys)
+        self._order_add(obj_id, created_at)
+        if self._aggregates is not None or self._columns is not None:
+            data = value if type(value) is dict \
+                else self.cls.codec().dump(value)
+            if self._aggregates is not None:
+                self._aggregates.add(obj_id, data)
+            if self._columns is not None:
+                self._columns.put(obj_id, data)
+        if self._text is not None:
+            self._text.add(obj_id, self._texts(value))
+
+    def _unstore(self, obj_id: str) -> bool:
+        """ Remove an object from DATA and the indexes (write lock held)
+        """
+        self._remove_keys(obj_id)
+        self._order_remove(obj_id)
+        self._fragments.pop(obj_id, None)
+        if self._aggregates is not None:
+            self._aggregates.remove(obj_id)
+        if self._text is not None:
+            self._text.remove(obj_id)
+        if self._columns is not None:
+            self._columns.remove(obj_id)
+        if self.shards > 1:
+            self._shard_ids[self.shard_of(obj_id)].discard(obj_id)
+        self._changes[obj_id] = None
+        with self._swap:
+            return self.objects.pop(obj_id, None) is not None
+
+    def shard_of(self, obj_id: str) -> int:
+        """ Shard of an object id
+        """
+        return zlib.crc32(obj_id.encode()) % self.shards
+
+    def shard_path(self, shard: int) -> str:
+        """ File of a shard
+        """
+        return ".db_{}.{}.json".format(self.s_class, shard)
+
+    def _paths(self, shards: int) -> list:
+        """ Files of the objects written with `shards` shards
+        """
+        if shards == 1:
+            return [self.file_path]
+        return [self.shard_path(k) for k in range(shards)]
+
+    def _source(self, header: bytes) -> tuple:
+        """ Identity of the objects saved when the journal with this
+        header line started
+        """
+        return (self.s_class, self.indexed, header)
+
+    def _build_index(self, objs_json: dict) -> dict:
+        """ Index of serialized objects: set of IDs by indexed attribute
+        and value
+        """
+        index = {attribute: {} for attribute in self.indexed}
+        for attribute, ids in index.items():
+            for obj_id, obj_json in objs_json.items():
+                try:
+                    ids.setdefault(obj_json.get(attribute), set()).add(obj_id)
+                except TypeError:
+                    continue
+        return index
+
+    def _read_files(self) -> tuple:
+        """ (objects, their index, number of shards they were written
+        with: 1 for the single file), from the binary snapshot when it is
+        up to date, else from the JSON file(s)
+        """
+        previous = read_json(self.manifest_path).get('shards', 1)
+        header = self._journal_header()
+        if self.binary_snapshot and header is not None:
+            content = read_snapshot(self.snapshot_path, self._source(header))
+            if content is not None:
+                return content + (previous,)
+        paths = self._paths(previous)
+        if previous == 1:
+            objs_json = read_json(self.file_path)
+        else:
+            executor = ProcessPoolExecutor \
+                if os.getenv('STORAGE_LOAD_EXECUTOR') == 'process' \
+                else ThreadPoolExecutor
+            objs_json = {}
+            with executor(max_workers=min(len(paths),
+                                          os.cpu_count() or 1)) as pool:
+                for shard_json in pool.map(read_json, paths):
+                    objs_json.update(shard_json)
+        return objs_json, self._build_index(objs_json), previous
+
+    def _reshard(self, previous: int):
+        """ Rewrite the files written with `previous` shards, removing the
+        stale ones (file lock held)
+        """
+        self.persist()
+        if self.shards > 1:
+            write_json(self.manifest_path, {'shards': self.shards})
+            stale = [self.shard_path(k)
+                     for k in range(self.shards, previous)]
+            if previous == 1:
+                stale.append(self.file_path)
+        else:
+            stale = [self.manifest_path] + \
+                [self.shard_path(k) for k in range(previous)]
+        for file_path in stale:
+            if path.exists(file_path):
+                os.remove(file_path)
+
+    @contextmanager
+    def _file_lock(self):
+        """ Exclusive lock of the store across processes (reentrant)
+        """
+        with self._flock_mutex:
+            if self._flock_depth == 0:
+                if self._flock_fd is None or self._flock_pid != os.getpid():
+                    self._flock_fd = os.open(self.lock_path,
+                                             os.O_RDWR | os.O_CREAT, 0o644)
+                    self._flock_pid = os.getpid()
+                fcntl.flock(self._flock_fd, fcntl.LOCK_EX)
+            self._flock_depth += 1
+            try:
+                yield
+            finally:
+                self._flock_depth -= 1
+                if self._flock_depth == 0:
+                    fcntl.flock(self._flock_fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _generation(fd: int) -> int:
+        """ Generation in the header line of an open journal (0 for a
+        journal written without one)
+        """
+        line = os.pread(fd, 256, 0).split(b"\n", 1)[0]
+        try:
+            return int(json.loads(line)['generation'])
+        except (ValueError, KeyError, TypeError):
+            return 0
+
+    def _journal_header(self) -> bytes:
+        """ Header line of the journal, None if there is none
+        """
+        try:
+            with open(self.journal_path, 'rb') as f:
+                return f.readline(256)
+        except FileNotFoundError:
+            return None
+
+    def _journal_state(self) -> tuple:
+        """ (generation, size) of the journal, (None, 0) if there is none
+        """
+        try:
+            fd = os.open(self.journal_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return (None, 0)
+        try:
+            return (self._generation(fd), os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+    def _start_journal(self):
+        """ Replace the journal by an empty one of the next generation,
+        counted in the lock file so that it only grows (file lock held)
+        """
+        stored = os.pread(self._flock_fd, 32, 0)
+        generation = max(int(stored or 0), self._journal_state()[0] or 0) + 1
+        os.pwrite(self._flock_fd, str(generation).encode(), 0)
+        os.ftruncate(self._flock_fd, len(str(generation)))
+        tmp_path = "{}.{}.tmp".format(self.journal_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'generation': generation,
+                                'id': uuid.uuid4().hex}) + "\n")
+        os.replace(tmp_path, self.journal_path)
+
+    @staticmethod
+    def _entry(op: str, obj_id: str, obj: TypeVar('Base') = None) -> str:
+        """ Journal line of a change, reusing the object's JSON fragment
+        """
+        if obj is None:
+            return '{{"op": "{}", "id": {}}}\n'.format(op, json.dumps(obj_id))
+        return '{{"op": "{}", "id": {}, "data": {}}}\n'.format(
+            op, json.dumps(obj_id), obj.fragment())
+
+    def _log(self, *entries: str):
+        """ Append journal lines (file lock held)
+        """
+        line = "".join(entries).encode()
+        if not path.exists(self.journal_path):
+            self._start_journal()
+            if self._journal == (None, 0):
+                # Nothing was missed: the journal is new
+                self._journal = self._journal_state()
+        fd = os.open(self.journal_path, os.O_RDWR | os.O_APPEND)
+        try:
+            state = (self._generation(fd), os.fstat(fd).st_size)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        METRICS.add(self.s_class, 'bytes_written', len(line))
+        if self._journal == state:
+            # Up to date: skip this write in refresh()
+            self._journal = (state[0], state[1] + len(line))
+
+    def _rotate(self):
+        """ Start an empty journal once it is too big (file lock held,
+        file saved): other workers see a new generation and reload the
+        file
+        """
+        if self._journal_state()[1] <= self.journal_max_bytes:
+            return
+        self._start_journal()
+        self._journal = self._journal_state()
+        if self.binary_snapshot:
+            # Not daemonic: exiting waits for the file to be complete
+            threading.Thread(target=self._write_snapshot,
+                             args=(self._snapshot, self._journal_header()),
+                             name="snapshot-{}".format(self.s_class)).start()
+
+    def _write_snapshot(self, snapshot: Snapshot, header: bytes):
+        """ Write the binary snapshot of the objects saved when the
+        journal with this header line started (off the request path)
+        """
+        dump = self.cls.codec().dump
+        with self._snapshot_lock, gc_paused():
+            objs_json = {obj_id: value if type(value) is dict
+                         else dump(value)
+                         for obj_id, value, _ in snapshot.items()}
+            write_snapshot(self.snapshot_path, self._source(header),
+                           (objs_json, self._build_index(objs_json)))
+
+    def refresh(self) -> int:
+        """ Apply the changes other processes made since the last call:
+        the journal delta, or the whole file after a journal rotation.
+        Return the number of changes applied (-1: full reload)
+        """
+        if self._journal == self._journal_state():
+            return 0
+        with self._file_lock():
+            state = self._journal_state()
+            if self._journal is None or self._journal == state:
+                return 0
+            generation, offset = self._journal
+            if state[0] != generation or state[1] < offset:
+                return self._reload()
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read()
+            # Only complete lines: a writer may be appending the next one
+            end = chunk.rfind(b"\n") + 1
+            try:
+                entries = [(entry['op'], entry['id'], entry.get('data'))
+                           for entry in map(json.loads,
+                                            chunk[:end].splitlines())
+                           if 'generation' not in entry]
+            except (ValueError, KeyError, TypeError):
+                # Not the journal the offset was taken in
+                return self._reload()
+            with self._writing():
+                for op, obj_id, data in entries:
+                    if op == 'delete':
+                        self._unstore(obj_id)
+                    else:
+                        self._store(obj_id, data)
+                self._journal = (generation, offset + end)
+        for op, obj_id, _ in entries:
+            FEED.emit(self.s_class, obj_id,
+                      'remove' if op == 'delete' else 'save')
+        return len(entries)
+
+    def _reload(self) -> int:
+        """ Load the whole file again (the journal restarted), published
+        as a 'reload' change
+        """
+        self.load()
+        FEED.emit(self.s_class, None, 'reload')
+        return -1
+
+    def load(self):
+        """ Load all objects from file, then replay the journal
+        """
+        with self._file_lock():
+            with gc_paused():
+                objs_json, index, previous = self._read_files()
+                keys = {obj_id: tuple(map(obj_json.get, self.indexed))
+                        for obj_id, obj_json in objs_json.items()}
+                snapshot = Snapshot.of(objs_json)
+                shard_ids = [set() for _ in range(self.shards)]
+                if self.shards > 1:
+                    for obj_id in objs_json:
+                        shard_ids[self.shard_of(obj_id)].add(obj_id)
+
+            with self._writing():
+                # Objects are kept serialized and only built on first access
+                DATA[self.s_class] = objs_json
+                self._index = index
+                self._keys = keys
+                self._orders = {}
+                self._created = {}
+                self._shard_ids = shard_ids
+                self._fragments = {}
+                self._aggregates = None
+                self._text = None
+                self._columns = None
+                self._snapshot = snapshot
+                self._changes = {}
+                # Changes the file may miss if a writer died before saving
+                self._journal = (self._journal_state()[0], 0)
+            if previous != self.shards:
+                self._reshard(previous)
+            self.refresh()
+
+    def persist(self, shards: set = None):
+        """ Save all objects to file (or only the given shards)
+        """
+        if self.shards == 1:
+            files = {self.file_path: None}
+        else:
+            files = {self.shard_path(k): k
+                     for k in (range(self.shards) if shards is None
+                               else shards)}
+        with self._file_lock(), self._persist_lock:
+            with self._lock.read():
+                snapshot = self._snapshot
+                ids = {shard: list(self._shard_ids[shard])
+                       for shard in files.values() if shard is not None}
+            for file_path, shard in files.items():
+                if shard is None:
+                    items = ((obj_id, value)
+                             for obj_id, value, _ in snapshot.items())
+                else:
+                    items = ((obj_id, snapshot.get(obj_id))
+                             for obj_id in ids[shard])
+                size = write_fragments(file_path, (
+                    (obj_id, self._fragment(obj_id, obj))
+                    for obj_id, obj in items), self.compresslevel)
+                METRICS.add(self.s_class, 'bytes_written', size)
+
+    def _fragment(self, obj_id: str, value) -> str:
+        """ Serialized JSON of an object or of its loaded dict
+        """
+        if type(value) is not dict:
+            return value.fragment()
+        cached = self._fragments.get(obj_id)
+        if cached is None or cached[0] is not value:
+            cached = (value, json.dumps(value))
+            if self.objects.get(obj_id) is value:
+                self._fragments[obj_id] = cached
+        return cached[1]
+
+    def get(self, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        bucket = self._snapshot.bucket(obj_id)
+        return self._hydrate(obj_id, bucket.get(obj_id), bucket)
+
+    def put(self, obj: TypeVar('Base')):
+        """ Store an object, log it and save the file
+        """
+        self.put_many([obj])
+
+    def put_if(self, obj: TypeVar('Base'), version: int) -> bool:
+        """ Store an object as version + 1 if the stored one (after the
+        other processes' changes) has this version
+        """
+        return self.put_many([obj], [version])[0]
+
+    def delete(self, obj_id: str) -> bool:
+        """ Remove an object, log it and save the file
+        """
+        return self.delete_if(obj_id, None)
+
+    def delete_if(self, obj_id: str, version: int) -> bool:
+        """ Remove an object if the stored one has this version (None:
+        any version)
+        """
+        with self._file_lock():
+            self.refresh()
+            with self._writing():
+                if version is not None and \
+                        version_of(self.objects.get(obj_id)) != version:
+                    return False
+                if not self._unstore(obj_id):
+                    return False
+            self._log(self._entry('delete', obj_id))
+            self.persist({self.shard_of(obj_id)})
+            self._rotate()
+        return True
+
+    def _drop_orders(self, changes: int):
+        """ Forget the sorted keys before many changes: they are cheaper
+        to sort again on the next page() than to update one by one
+        (write lock held)
+        """
+        if changes > 64:
+            self._orders = {}
+            self._created = {}
+
+    def put_many(self, objs: List[TypeVar('Base')],
+                 versions: List[int] = None) -> List[bool]:
+        """ Store several objects, each one as the stored version + 1
+        (after the other processes' changes) if the stored one has the
+        matching item of `versions` (None: any version), log them and
+        save the files once
+        """
+        if len(objs) == 0:
+            return []
+        with self._file_lock():
+            self.refresh()
+            done = []
+            with self._writing():
+                self._drop_orders(len(objs))
+                for obj, version in zip(objs,
+                                        versions or [None] * len(objs)):
+                    stored = version_of(self.objects.get(obj.id))
+                    if version is not None and stored != version:
+                        done.append(False)
+                        continue
+                    obj.version = (stored or 0) + 1
+                    self._store(obj.id, obj)
+                    done.append(True)
+            objs = [obj for obj, ok in zip(objs, done) if ok]
+            if len(objs) > 0:
+                self._log(*(self._entry('put', obj.id, obj)
+                            for obj in objs))
+                self.persist({self.shard_of(obj.id) for obj in objs})
+                self._rotate()
+        return done
+
+    def delete_many(self, obj_ids: List[str]) -> List[bool]:
+        """ Remove several objects, log them and save the files once
+        """
+        with self._file_lock():
+            self.refresh()
+            with self._writing():
+                self._drop_orders(len(obj_ids))
+                deleted = [self._unstore(obj_id) for obj_id in obj_ids]
+            removed = [obj_id for obj_id, done in zip(obj_ids, deleted)
+                       if done]
+            if len(removed) > 0:
+                self._log(*(self._entry('delete', obj_id)
+                            for obj_id in removed))
+                self.persist({self.shard_of(obj_id) for obj_id in removed})
+                self._rotate()
+        return deleted
+
+    def scan(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects of the current snapshot
+        """
+        for obj_id, obj, bucket in self._snapshot.items():
+            yield self._hydrate(obj_id, obj, bucket)
+
+    def count(self) -> int:
+        """ Number of objects
+        """
+        return len(self._snapshot)
+
+    def memory_count(self) -> int:
+        """ Number of objects held in memory: all of them
+        """
+        return len(self._snapshot)
+
+    def lookup(self, attribute: str,
+               value) -> Iterable[TypeVar('Base')]:
+        """ Objects saved with `attribute` equal to `value`
+        """
+        with self._lock.read():
+            try:
+                ids = list(self._index[attribute].get(value, ()))
+            except (KeyError, TypeError):
+                return self.scan()
+            return [self.get(obj_id) for obj_id in ids]
+
+    def _key_range(self, predicate: TypeVar('Predicate')) -> list:
+        """ Sorted keys matching a range or prefix predicate on
+        id/created_at, None if the predicate isn't one of those
+        """
+        low, high = None, None
+        if predicate.attribute == 'id' and predicate.op == 'prefix':
+            if type(predicate.value) is not str:
+                return None
+            low, high = predicate.value, predicate.value + '\U0010ffff'
+        elif predicate.op == 'range' and \
+                predicate.attribute in ('id', 'created_at'):
+            low, high = predicate.value
+            if predicate.attribute == 'created_at':
+                bounds = timestamp_range(low, high)
+                if bounds is None:
+                    return None
+                low, high = bounds
+        else:
+            return None
+        with self._lock.read():
+            keys = self._ordered(predicate.attribute)
+            try:
+                start = 0 if low is None else bisect_left(keys, (low,))
+                end = len(keys) if high is None else \
+                    bisect_left(keys, (high,))
+            except TypeError:
+                return None
+            return keys[start:max(start, end)]
+
+    def estimate(self, predicate: TypeVar('Predicate')) -> int:
+        """ Exact number of candidates given by the indexes
+        """
+        if predicate.op in ('eq', 'in'):
+            values = predicate.values()
+            try:
+                if predicate.attribute == 'id':
+                    return sum(1 for value in values
+                               if value in self.objects)
+                if predicate.attribute in self.indexed:
+                    with self._lock.read():
+                        index = self._index[predicate.attribute]
+                        return sum(len(index.get(value, ()))
+                                   for value in values)
+            except TypeError:
+                return None
+            return None
+        key_range = self._key_range(predicate)
+        return None if key_range is None else len(key_range)
+
+    def candidates(self, predicate: TypeVar('Predicate')
+                   ) -> Iterator[TypeVar('Base')]:
+        """ Objects of the index serving predicate
+        """
+        key_range = None
+        if predicate.op in ('range', 'prefix'):
+            key_range = self._key_range(predicate)
+        if key_range is None:
+            yield from super().candidates(predicate)
+            return
+        for key in key_range:
+            obj = self.get(key[-1])
+            if obj is not None:
+                yield obj
+
+    def aggregate(self, name: str) -> dict:
+        """ Number of objects by group of the metric `name`, from the
+        counters kept up to date by save/remove/load
+        """
+        if name not in self.metrics:
+            raise ValueError("Unknown aggregate: {}".format(name))
+        with self._lock.read():
+            aggregates = self._aggregates
+            if aggregates is None:
+                with self._mutex:
+                    aggregates = self._aggregates
+                    if aggregates is None:
+                        aggregates = Aggregates(self.metrics)
+                        dump = self.cls.codec().dump
+                        for obj_id, obj in self.objects.items():
+                            aggregates.add(obj_id, obj if type(obj) is dict
+                                           else dump(obj))
+                        self._aggregates = aggregates
+            return dict(aggregates.counts[name])
+
+    def columns(self) -> Columns:
+        """ Copy of the columnar shadow of the objects, kept up to date
+        by save/remove/load once built
+        """
+        with self._lock.read():
+            columns = self._columns
+            if columns is None:
+                with self._mutex:
+                    columns = self._columns
+                    if columns is None:
+                        columns = Columns(self.column_specs)
+                        dump = self.cls.codec().dump
+                        for obj_id, obj in self.objects.items():
+                            columns.put(obj_id, obj if type(obj) is dict
+                                        else dump(obj))
+                        self._columns = columns
+            return columns.copy()
+
+    def _texts(self, value) -> tuple:
+        """ Searchable texts of an object or of its serialized dict
+        """
+        if type(value) is dict:
+            return tuple(value.get(attribute) for attribute in self.searchable)
+        return tuple(getattr(value, attribute, None)
+                     for attribute in self.searchable)
+
+    def text_search(self, query: str,
+                    limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects whose searchable attributes have a word starting with
+        each word of query, from the TextIndex
+        """
+        with self._lock.read():
+            text = self._text
+            if text is None:
+                with self._mutex:
+                    text = self._text
+                    if text is None:
+                        text = TextIndex.of(
+                            (obj_id, self._texts(value))
+                            for obj_id, value in self.objects.items())
+                        self._text = text
+            ids = text.search(query, limit)
+        return [obj for obj in map(self.get, ids) if obj is not None]
+
+    def page(self, order_by: str = 'id', after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Up to `limit` objects following the cursor `after`
+        """
+        if order_by not in ORDERS:
+            raise ValueError("Unknown order: {}".format(order_by))
+        with self._lock.read():
+            keys = self._ordered(order_by)
+            start = 0
+            if after is not None:
+                start = bisect_right(keys, cursor_key(after, order_by))
+            end = len(keys) if limit is None else start + limit
+            return [self.get(key[-1]) for key in keys[start:end]]
+
+    def search(self, attributes: dict) -> List[TypeVar('Base')]:
+        """ All objects with matching attributes
+        """
+        if any(attribute in attributes for attribute in self.indexed):
+            with self._lock.read():
+                return super().search(attributes)
+        snapshot = self._snapshot
+        METRICS.add(self.s_class, 'search_scanned', len(snapshot))
+        raw_fields = self.cls.codec().raw_fields
+
+        def _search(obj_id, obj, bucket):
+            for k, v in attributes.items():
+                if type(obj) is dict and k in raw_fields and k in obj:
+                    # Compare serialized values without building the object
+                    if obj[k] != v:
+                        return False
+                    continue
+                obj = self._hydrate(obj_id, obj, bucket)
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        return [self._hydrate(obj_id, obj, bucket)
+                for obj_id, obj, bucket in snapshot.items()
+                if _search(obj_id, obj, bucket)]
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+""" Memory-mapped hash table storage engine module
+"""
+from contextlib import contextmanager
+from os import getenv, path
+from typing import Iterator, List, TypeVar
+from models.aggregates import apply, changes
+from models.changes import FEED
+from models.engines.engine import StorageEngine, version_of
+from models.engines.json_file import read_json
+from models.metrics import METRICS
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+MAGIC = b'BASEIDX1'
+VERSION = 1
+# magic, version, flags, capacity, count, used slots, committed data end
+HEADER = struct.Struct('<8sIIQQQQ')
+HEADER_SIZE = 64
+# key hash, record offset, record length, state
+SLOT = struct.Struct('<QQII')
+# key length, payload length, crc32 of key + payload
+RECORD = struct.Struct('<III')
+EMPTY, LIVE, DELETED = 0, 1, 2
+CLEAN, DIRTY = 0, 1
+MAX_LOAD = 0.7
+# Slots read by scan() per lock hold
+SCAN_SLOTS = 1024
+
+
+def key_hash(key: bytes) -> int:
+    """ Stable 64 bits hash of a key (same in every process)
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(),
+                          'little')
+
+
+class MmapHashEngine(StorageEngine):
+    """ Objects stored in memory-mapped files
+
+    .db_<class>.idx is a header followed by a fixed-size open-addressing
+    (linear probing) hash table keyed by object id; .db_<class>.dat is an
+    append-only region of checksummed records (an empty payload records
+    a deletion). Opening costs O(1) whatever the size, get() touches a few
+    pages, and the page cache is shared by every worker process.
+
+    Writers hold an exclusive flock and mark the header DIRTY while they
+    mutate; the table grows in place (rehash) beyond MAX_LOAD. On open, a
+    DIRTY or inconsistent header makes the table be rebuilt from the data
+    region, and an uncommitted tail of the data region is truncated.
+
+    Every change appends to the data region, so refresh() tells the
+    other processes' writes from a moved `data_end` (own writes are
+    adopted as they are made).
+
+    Once aggregate() has counted the `_aggregates` metrics (with a scan),
+    each write appends the deltas of the counters and the data end they
+    reach to .db_<class>.aggregates, under the same lock; every process
+    reads only the lines it hasn't applied yet. The journal is rewritten
+    as a single line of counters past STORAGE_JOURNAL_MAX_BYTES, and
+    counted again if it doesn't reach the data end (after a crash).
+    """
+
+    def __init__(self, cls: type):
+        """ Initialize the engine of cls
+        """
+        super().__init__(cls)
+        self.idx_path = ".db_{}.idx".format(self.s_class)
+        self.dat_path = ".db_{}.dat".format(self.s_class)
+        self.aggregates_path = ".db_{}.aggregates".format(self.s_class)
+        self.aggregates_max_bytes = int(getenv('STORAGE_JOURNAL_MAX_BYTES',
+                                               str(1 << 20)))
+        self.initial_capacity = 1
+        while self.initial_capacity < int(getenv('MMAP_CAPACITY', '1024')):
+            self.initial_capacity *= 2
+        self.codec = cls.codec()
+        self._lock = threading.RLock()
+        self._pid = None
+        self._idx_fd = None
+        self._dat_fd = None
+        self._idx_map = None
+        self._dat_map = None
+        self._data_end = None
+        self._counts = None
+        self._counts_file = None
+        self._counts_offset = 0
+        self._counts_end = None
+
+    def _open(self):
+        """ Open and map the files (again after a fork)
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._idx_fd = os.open(self.idx_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._dat_fd = os.open(self.dat_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._idx_map = None
+        self._dat_map = None
+        fcntl.flock(self._idx_fd, fcntl.LOCK_EX)
+        try:
+            self._recover()
+        finally:
+            fcntl.flock(self._idx_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        """ Hold the thread lock and the file lock, with a current mapping
+        """
+        with self._lock:
+            self._open()
+            fcntl.flock(self._idx_fd,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._map_idx()
+                if exclusive:
+                    data_end = self._header()['data_end']
+                    self._set_header(flags=DIRTY)
+                yield
+                if exclusive:
+                    self._set_header(flags=CLEAN)
+                    if self._data_end == data_end:
+                        # Up to date before this write: adopt it
+                        self._data_end = self._header()['data_end']
+            finally:
+                fcntl.flock(self._idx_fd, fcntl.LOCK_UN)
+
+    def _map_idx(self):
+        """ (Re)map the index file if another writer resized it
+        """
+        capacity = HEADER.unpack(os.pread(self._idx_fd, HEADER.size, 0))[3]
+        size = HEADER_SIZE + capacity * SLOT.size
+        if self._idx_map is None or len(self._idx_map) != size:
+            if self._idx_map is not None:
+                self._idx_map.close()
+            self._idx_map = mmap.mmap(self._idx_fd, size)
+
+    def _header(self) -> dict:
+        """ Header fields of the index
+        """
+        names = ('magic', 'version', 'flags', 'capacity', 'count', 'used',
+                 'data_end')
+        return dict(zip(names, HEADER.unpack_from(self._idx_map, 0)))
+
+    def _set_header(self, **fields: dict):
+        """ Update header fields of the index
+        """
+        header = self._header()
+        header.update(fields)
+        HEADER.pack_into(self._idx_map, 0, *header.values())
+
+    def _data(self, end: int) -> mmap.mmap:
+        """ Mapping of the data file covering [0, end)
+        """
+        if self._dat_map is None or len(self._dat_map) < end:
+            if self._dat_map is not None:
+                self._dat_map.close()
+            self._dat_map = mmap.mmap(self._dat_fd,
+                                      os.fstat(self._dat_fd).st_size)
+        return self._dat_map
+
+    def _recover(self):
+        """ Check the files on open, rebuilding or truncating as needed
+        """
+        idx_size = os.fstat(self._idx_fd).st_size
+        dat_size = os.fstat(self._dat_fd).st_size
+        if idx_size < HEADER_SIZE:
+            self._rebuild(dat_size)
+            return
+        header = HEADER.unpack(os.pread(self._idx_fd, HEADER.size, 0))
+        magic, version, flags, capacity, count, used, data_end = header
+        if magic != MAGIC or version != VERSION or flags != CLEAN or \
+                idx_size != HEADER_SIZE + capacity * SLOT.size or \
+                dat_size < data_end:
+            self._rebuild(dat_size)
+        elif dat_size > data_end:
+            # Appended but never committed to the index
+            os.ftruncate(self._dat_fd, data_end)
+
+    def _rebuild(self, dat_size: int):
+        """ Rebuild the index from the valid records of the data file
+        """
+        entries = {}
+        offset = 0
+        data = mmap.mmap(self._dat_fd, dat_size) if dat_size else b''
+        try:
+            while offset + RECORD.size <= dat_size:
+                key_len, payload_len, crc = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + key_len + payload_len
+                body = data[offset + RECORD.size:end]
+                if end > dat_size or zlib.crc32(body) != crc:
+                    break
+                key = body[:key_len]
+                if payload_len == 0:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = (offset, end - offset)
+                offset = end
+        finally:
+            if dat_size:
+                data.close()
+        os.ftruncate(self._dat_fd, offset)
+        capacity = self.initial_capacity
+        while len(entries) > capacity * MAX_LOAD:
+            capacity *= 2
+        os.ftruncate(self._idx_fd, 0)
+        os.ftruncate(self._idx_fd, HEADER_SIZE + capacity * SLOT.size)
+        self._idx_map = mmap.mmap(self._idx_fd,
+                                  HEADER_SIZE + capacity * SLOT.size)
+        HEADER.pack_into(self._idx_map, 0, MAGIC, VERSION, DIRTY, capacity,
+                         len(entries), len(entries), offset)
+        for key, (record_offset, length) in entries.items():
+            self._insert(key_hash(key), record_offset, length, capacity)
+        self._set_header(flags=CLEAN)
+        self._idx_map.flush()
+
+    def _insert(self, h: int, offset: int, length: int, capacity: int):
+        """ Put an entry in the first free slot (no key check)
+        """
+        i = h & (capacity - 1)
+        while True:
+            pos = HEADER_SIZE + i * SLOT.size
+            if SLOT.unpack_from(self._idx_map, pos)[3] != LIVE:
+                SLOT.pack_into(self._idx_map, pos, h, offset, length, LIVE)
+                return
+            i = (i + 1) & (capacity - 1)
+
+    def _find(self, key: bytes) -> tuple:
+        """ (slot index of key or None, first reusable slot index)
+        """
+        h = key_hash(key)
+        capacity = self._header()['capacity']
+        i = h & (capacity - 1)
+        free = None
+        for _ in range(capacity):
+            slot_h, offset, length, state = SLOT.unpack_from(
+                self._idx_map, HEADER_SIZE + i * SLOT.size)
+            if state == EMPTY:
+                return None, i if free is None else free
+            if state == DELETED:
+                if free is None:
+                    free = i
+            elif slot_h == h and self._read(offset, length)[0] == key:
+                return i, free
+            i = (i + 1) & (capacity - 1)
+        return None, free
+
+    def _grow(self, capacity: int):
+        """ Rehash the table in place into `capacity` slots
+        """
+        old = self._header()
+        entries = []
+        for i in range(old['capacity']):
+            h, offset, length, state = SLOT.unpack_from(
+                self._idx_map, HEADER_SIZE + i * SLOT.size)
+            if state == LIVE:
+                entries.append((h, offset, length))
+        size = HEADER_SIZE + capacity * SLOT.size
+        self._idx_map.close()
+        os.ftruncate(self._idx_fd, size)
+        self._idx_map = mmap.mmap(self._idx_fd, size)
+        self._idx_map[HEADER_SIZE:] = bytes(size - HEADER_SIZE)
+        for h, offset, length in entries:
+            self._insert(h, offset, length, capacity)
+        self._set_header(capacity=capacity, used=len(entries))
+
+    def _read(self, offset: int, length: int) -> tuple:
+        """ (key, payload) of the record at offset
+        """
+        data = self._data(offset + length)
+        key_len, payload_len, crc = RECORD.unpack_from(data, offset)
+        body = data[offset + RECORD.size:offset + length]
+        if zlib.crc32(body) != crc:
+            raise ValueError("Corrupted record at {} in {}".format(
+                offset, self.dat_path))
+        return body[:key_len], body[key_len:]
+
+    def _append(self, key: bytes, payload: bytes) -> tuple:
+        """ Append a record, return its (offset, length)
+        """
+        offset = self._header()['data_end']
+        body = key + payload
+        record = RECORD.pack(len(key), len(payload), zlib.crc32(body)) + body
+        os.pwrite(self._dat_fd, record, offset)
+        METRICS.add(self.s_class, 'bytes_written', len(record))
+        self._set_header(data_end=offset + len(record))
+        return offset, len(record)
+
+    def _decode(self, payload: bytes) -> TypeVar('Base'):
+        """ Object of a record payload
+        """
+        return self.codec.load(json.loads(payload))
+
+    def load(self):
+        """ Open the store, importing .db_<class>.json when it is empty
+        """
+        with self._locked():
+            self._data_end = self._header()['data_end']
+            empty = self._header()['count'] == 0 and \
+                os.fstat(self._dat_fd).st_size == 0
+        file_path = ".db_{}.json".format(self.s_class)
+        if not empty or not path.exists(file_path):
+            return
+        objs_json = read_json(file_path)
+        with self._locked(exclusive=True):
+            for obj_id, obj_json in objs_json.items():
+                self._put(obj_id.encode(), json.dumps(obj_json).encode())
+
+    def refresh(self) -> int:
+        """ -1 if other processes wrote since the last load/refresh (the
+        changes aren't itemized, see models.changes), else 0
+        """
+        if self._data_end is None:
+            return 0
+        with self._locked():
+            data_end = self._header()['data_end']
+        if data_end == self._data_end:
+            return 0
+        self._data_end = data_end
+        FEED.emit(self.s_class, None, 'reload')
+        return -1
+
+    def persist(self):
+        """ Flush the mappings and the data file to disk
+        """
+        with self._locked():
+            self._idx_map.flush()
+            os.fsync(self._dat_fd)
+
+    def get(self, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        if type(obj_id) is not str:
+            return None
+        with self._locked():
+            i, _ = self._find(obj_id.encode())
+            if i is None:
+                return None
+            _, offset, length, _ = SLOT.unpack_from(
+                self._idx_map, HEADER_SIZE + i * SLOT.size)
+            payload = self._read(offset, length)[1]
+        return self._decode(payload)
+
+    def contains(self, obj_id: str) -> bool:
+        """ True if a live slot has this ID
+        """
+        with self._locked():
+            return self._find(obj_id.encode())[0] is not None
+
+    def _put(self, key: bytes, payload: bytes):
+        """ Append a record and point the key's slot to it
+        """
+        header = self._header()
+        if header['used'] + 1 > header['capacity'] * MAX_LOAD:
+            self._grow(header['capacity'] * 2)
+        i, free = self._find(key)
+        offset, length = self._append(key, payload)
+        if i is None:
+            i = free
+            header = self._header()
+            state = SLOT.unpack_from(
+                self._idx_map, HEADER_SIZE + i * SLOT.size)[3]
+            self._set_header(count=header['count'] + 1,
+                             used=header['used'] + (state == EMPTY))
+        SLOT.pack_into(self._idx_map, HEADER_SIZE + i * SLOT.size,
+                       key_hash(key), offset, length, LIVE)
+
+    def put(self, obj: TypeVar('Base')):
+        """ Append the object and update its slot
+        """
+        self.put_many([obj])
+
+    def _stored(self, key: bytes) -> dict:
+        """ Serialized dict of the live record of a key, None if missing
+        (file lock held)
+        """
+        i, _ = self._find(key)
+        if i is None:
+            return None
+        _, offset, length, _ = SLOT.unpack_from(
+            self._idx_map, HEADER_SIZE + i * SLOT.size)
+        return json.loads(self._read(offset, length)[1])
+
+    def put_if(self, obj: TypeVar('Base'), version: int) -> bool:
+        """ Append the object as version + 1 if its live record has this
+        version
+        """
+        return self.put_many([obj], [version])[0]
+
+    def put_many(self, objs: List[TypeVar('Base')],
+                 versions: List[int] = None) -> List[bool]:
+        """ Append several objects, each one as the version of its live
+        record + 1 if that is the matching item of `versions` (None: any
+        version), under one exclusive file lock
+        """
+        done = []
+        deltas = []
+        with self._locked(exclusive=True):
+            for obj, version in zip(objs, versions or [None] * len(objs)):
+                key = obj.id.encode()
+                old = self._stored(key)
+                stored = version_of(old)
+                if version is not None and stored != version:
+                    done.append(False)
+                    continue
+                obj.version = (stored or 0) + 1
+                self._put(key, obj.fragment().encode())
+                if self.metrics:
+                    deltas += changes(self.metrics, old,
+                                      self.codec.dump(obj))
+                done.append(True)
+            self._count(deltas)
+        return done
+
+    def delete(self, obj_id: str) -> bool:
+        """ Append a deletion record and free the slot
+        """
+        return self.delete_if(obj_id, None)
+
+    def delete_if(self, obj_id: str, version: int) -> bool:
+        """ Append a deletion record and free the slot if the live record
+        has this version (None: any version)
+        """
+        key = obj_id.encode()
+        with self._locked(exclusive=True):
+            i, _ = self._find(key)
+            if i is None:
+                return False
+            old = self._stored(key)
+            if version is not None and version_of(old) != version:
+                return False
+            self._append(key, b'')
+            pos = HEADER_SIZE + i * SLOT.size
+            h, offset, length, _ = SLOT.unpack_from(self._idx_map, pos)
+            SLOT.pack_into(self._idx_map, pos, h, offset, length, DELETED)
+            self._set_header(count=self._header()['count'] - 1)
+            self._count(changes(self.metrics, old, None))
+        return True
+
+    def _count(self, deltas: List[tuple]):
+        """ Append the counter deltas of a write (see
+        models.aggregates.changes) and the data end it reached to the
+        aggregates journal, if there is one (exclusive file lock held)
+        """
+        try:
+            fd = os.open(self.aggregates_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, json.dumps({'end': self._header()['data_end'],
+                                     'deltas': deltas}).encode() + b'\n')
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.aggregates_max_bytes:
+            counts = self._read_counts()
+            if counts is not None:
+                self._write_counts(counts)
+
+    def _read_counts(self) -> dict:
+        """ Counters of the aggregates journal, applying the lines not
+        read yet; None if there is none, if it lacks a metric or doesn't
+        reach the data end (file lock held)
+        """
+        try:
+            with open(self.aggregates_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if (stat.st_dev, stat.st_ino) != self._counts_file or \
+                        stat.st_size < self._counts_offset:
+                    # New or rewritten journal
+                    self._counts = None
+                    self._counts_file = (stat.st_dev, stat.st_ino)
+                    self._counts_offset = 0
+                f.seek(self._counts_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        data = data[:data.rfind(b'\n') + 1]
+        try:
+            for line in data.splitlines():
+                entry = json.loads(line)
+                if 'counts' in entry:
+                    self._counts = {name: {} for name in entry['metrics']}
+                    apply(self._counts, entry['counts'])
+                else:
+                    apply(self._counts, entry['deltas'])
+                self._counts_end = entry['end']
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self._counts = None
+            self._counts_file = None
+            return None
+        self._counts_offset += len(data)
+        if self._counts is None or \
+                any(name not in self._counts for name in self.metrics) or \
+                self._counts_end != self._header()['data_end']:
+            return None
+        return self._counts
+
+    def _write_counts(self, counts: dict):
+        """ Write the aggregates journal as a single line of counters
+        (exclusive file lock held)
+        """
+        data_end = self._header()['data_end']
+        line = json.dumps({
+            'end': data_end, 'metrics': list(counts),
+            'counts': [(name, group, count)
+                       for name, groups in counts.items()
+                       for group, count in groups.items()]}).encode() + b'\n'
+        tmp_path = self.aggregates_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(line)
+        os.replace(tmp_path, self.aggregates_path)
+        stat = os.stat(self.aggregates_path)
+        self._counts = counts
+        self._counts_file = (stat.st_dev, stat.st_ino)
+        self._counts_offset = len(line)
+        self._counts_end = data_end
+
+    def aggregate(self, name: str) -> dict:
+        """ Number of objects by group of the metric `name`, from the
+        aggregates journal (counted with a scan the first time)
+        """
+        if name not in self.metrics:
+            raise ValueError("Unknown aggregate: {}".format(name))
+        with self._locked():
+            counts = self._read_counts()
+            if counts is not None:
+                return dict(counts[name])
+        with self._locked(exclusive=True):
+            counts = self._read_counts()
+            if counts is None:
+                counts = {name: {} for name in self.metrics}
+                for i in range(self._header()['capacity']):
+                    _, offset, length, state = SLOT.unpack_from(
+                        self._idx_map, HEADER_SIZE + i * SLOT.size)
+                    if state == LIVE:
+                        apply(counts, changes(self.metrics, None, json.loads(
+                            self._read(offset, length)[1])))
+                self._write_counts(counts)
+            return dict(counts[name])
+
+    def scan(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects, in table order, SCAN_SLOTS slots per
+        lock hold (writers go on between them; objects moved by a table
+        growth meanwhile may be missed or seen twice)
+        """
+        start = 0
+        while True:
+            payloads = []
+            with self._locked():
+                capacity = self._header()['capacity']
+                end = min(start + SCAN_SLOTS, capacity)
+                for i in range(start, end):
+                    _, offset, length, state = SLOT.unpack_from(
+                        self._idx_map, HEADER_SIZE + i * SLOT.size)
+                    if state == LIVE:
+                        payloads.append(self._read(offset, length)[1])
+            for payload in payloads:
+                yield self._decode(payload)
+            if end >= capacity:
+                return
+            start = end
+
+    def count(self) -> int:
+        """ Number of objects (kept in the header)
+        """
+        with self._locked():
+            return self._header()['count']
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+""" Readers-writer lock module
+"""
+from contextlib import contextmanager
+import threading
+
+
+class RWLock():
+    """ Readers-writer lock preferring writers
+
+    Any number of threads may read at once; a writer waits for them and
+    blocks new readers. Reads are reentrant and the writing thread may
+    read, but a reading thread can't start writing.
+    """
+
+    def __init__(self):
+        """ Initialize an unlocked lock
+        """
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        """ Hold the lock for reading
+        """
+        depth = getattr(self._local, 'depth', 0)
+        acquire = depth == 0 and self._writer != threading.get_ident()
+        if acquire:
+            with self._cond:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if acquire:
+                with self._cond:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        """ Hold the lock for writing
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, 'depth', 0):
+            raise RuntimeError("Can't write while holding a read lock")
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+""" Snapshot module: immutable versions of the objects of a store
+"""
+from typing import Iterator
+
+
+class Snapshot():
+    """ Point-in-time view of objects (or their serialized dict) by ID
+
+    The objects are spread over BUCKETS dicts by hash of their ID. A
+    published snapshot never changes, except when a serialized dict is
+    swapped for the instance built from it: with_changes() returns the
+    next version, copying only the buckets it touches. Readers iterate
+    their version without any lock while writers publish new ones.
+    """
+    BUCKETS = 256
+
+    def __init__(self, buckets: tuple, count: int, version: int = 0):
+        """ Initialize a snapshot of count objects
+        """
+        self.buckets = buckets
+        self.count = count
+        self.version = version
+
+    @classmethod
+    def of(cls, objects: dict) -> 'Snapshot':
+        """ First version of a store holding objects
+        """
+        buckets = tuple({} for _ in range(cls.BUCKETS))
+        mask = cls.BUCKETS - 1
+        for obj_id, value in objects.items():
+            buckets[hash(obj_id) & mask][obj_id] = value
+        return cls(buckets, len(objects))
+
+    def bucket(self, obj_id: str) -> dict:
+        """ Bucket holding obj_id
+        """
+        return self.buckets[hash(obj_id) & (self.BUCKETS - 1)]
+
+    def get(self, obj_id: str):
+        """ Object (or serialized dict) of obj_id, None if missing
+        """
+        return self.bucket(obj_id).get(obj_id)
+
+    def __len__(self) -> int:
+        """ Number of objects
+        """
+        return self.count
+
+    def items(self) -> Iterator[tuple]:
+        """ (ID, object or serialized dict, bucket) of every object
+        """
+        for bucket in self.buckets:
+            for obj_id, value in bucket.items():
+                yield obj_id, value, bucket
+
+    def with_changes(self, changes: dict) -> 'Snapshot':
+        """ Next version: objects by ID replaced, None ones removed
+        """
+        buckets = list(self.buckets)
+        copied = set()
+        count = self.count
+        mask = self.BUCKETS - 1
+        for obj_id, value in changes.items():
+            k = hash(obj_id) & mask
+            if k not in copied:
+                buckets[k] = dict(buckets[k])
+                copied.add(k)
+            bucket = buckets[k]
+            if value is None:
+                if bucket.pop(obj_id, None) is not None:
+                    count -= 1
+            else:
+                if obj_id not in bucket:
+                    count += 1
+                bucket[obj_id] = value
+        return Snapshot(tuple(buckets), count, self.version + 1)
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+""" SQLite storage engine module
+"""
+from datetime import datetime
+from os import getenv
+from typing import Iterable, Iterator, List, TypeVar
+from models.aggregates import changes
+from models.changes import FEED
+from models.codec import TIMESTAMP_FORMAT, encode_timestamp
+from models.engines.engine import ORDERS, StorageEngine, cursor_key, \
+    timestamp_range
+from models.engines.json_file import read_json
+from models.metrics import METRICS
+import json
+import sqlite3
+import threading
+
+
+SQL_TYPES = (str, int, float, type(None))
+# Rows read by each query of the iterators
+BATCH_SIZE = 500
+
+
+class SQLiteEngine(StorageEngine):
+    """ Objects stored one row per object in a SQLite table
+
+    The table is named after the class with one column per serialized
+    slotted field (str, int, float or None values); attributes listed in
+    `_indexed` get an SQL index. Nothing is loaded at startup and each
+    save writes a single row. The database file is SQLITE_PATH (default:
+    .db.sqlite3). refresh() tells other processes' commits from SQLite's
+    data_version.
+
+    The counters of the `_aggregates` metrics are kept in the table
+    <class>_aggregates (metric, JSON group, count), adjusted in the
+    transaction of each write and counted with a scan only once per
+    metric (marked by a row of group ''), so aggregate() reads a few
+    rows.
+    """
+
+    ordered = True
+
+    def __init__(self, cls: type):
+        """ Initialize the engine of cls
+        """
+        super().__init__(cls)
+        self.db_path = getenv('SQLITE_PATH', '.db.sqlite3')
+        self.codec = cls.codec()
+        self.sql_columns = tuple(self.codec.key(field)
+                                 for field in self.codec.fields)
+        self.aggregates_table = self.quote(
+            "{}_aggregates".format(self.s_class))
+        self._lock = threading.Lock()
+        self._connection = None
+        self._data_version = None
+
+    @staticmethod
+    def quote(name: str) -> str:
+        """ SQL identifier
+        """
+        return '"{}"'.format(name.replace('"', '""'))
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ Connection to the database, schema created on first use
+        """
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.db_path,
+                                               check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._create_table()
+        return self._connection
+
+    def _create_table(self):
+        """ Create (or add missing columns to) the table and its indexes
+        """
+        table = self.quote(self.s_class)
+        db = self._connection
+        columns = ["id TEXT PRIMARY KEY"]
+        columns += [self.quote(column) for column in self.sql_columns
+                    if column != 'id']
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+                table, ", ".join(columns)))
+            existing = [row['name'] for row in
+                        db.execute("PRAGMA table_info({})".format(table))]
+            for column in self.sql_columns:
+                if column not in existing:
+                    db.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                        table, self.quote(column)))
+            for attribute in self.indexed:
+                db.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                    self.quote("idx_{}_{}".format(self.s_class, attribute)),
+                    table, self.quote(attribute)))
+            if 'created_at' in self.sql_columns:
+                db.execute("CREATE INDEX IF NOT EXISTS {} ON {} "
+                           "(created_at, id)".format(
+                               self.quote("idx_{}_created_at_id".format(
+                                   self.s_class)), table))
+            if self.metrics:
+                self._create_aggregates(db)
+
+    def _create_aggregates(self, db: sqlite3.Connection):
+        """ Create the aggregates table and count the metrics it doesn't
+        have yet with a scan (in the schema transaction)
+        """
+        db.execute("CREATE TABLE IF NOT EXISTS {} (metric TEXT, grp TEXT, "
+                   "count INTEGER, PRIMARY KEY (metric, grp))".format(
+                       self.aggregates_table))
+        counted = {row[0] for row in db.execute(
+            "SELECT metric FROM {} WHERE grp = ''".format(
+                self.aggregates_table))}
+        missing = {name: metric for name, metric in self.metrics.items()
+                   if name not in counted}
+        if not missing:
+            return
+        deltas = []
+        for row in db.execute("SELECT * FROM {}".format(
+                self.quote(self.s_class))):
+            deltas += changes(missing, None, dict(zip(row.keys(), row)))
+        self._count(db, deltas)
+        db.executemany("INSERT INTO {} (metric, grp, count) VALUES "
+                       "(?, '', 0)".format(self.aggregates_table),
+                       [(name,) for name in missing])
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        """ Run a statement and fetch its rows
+        """
+        with self._lock:
+            db = self.connection
+            with db:
+                return db.execute(sql, params).fetchall()
+
+    def _row(self, data: dict) -> tuple:
+        """ Column values of a serialized object
+        """
+        return tuple(data.get(column) for column in self.sql_columns)
+
+    def _load(self, row: sqlite3.Row) -> TypeVar('Base'):
+        """ Object of a row
+        """
+        return self.codec.load(dict(zip(row.keys(), row)))
+
+    def load(self):
+        """ Open the table, importing .db_<class>.json when it is empty
+        """
+        self._data_version = self._execute("PRAGMA data_version")[0][0]
+        if self._execute("SELECT 1 FROM {} LIMIT 1".format(
+                self.quote(self.s_class))):
+            return
+        objs_json = read_json(".db_{}.json".format(self.s_class))
+        self.put_rows([self._row(obj_json) for obj_json in objs_json.values()])
+
+    def refresh(self) -> int:
+        """ -1 if other connections committed since the last load/refresh
+        (the changes aren't itemized, see models.changes), else 0
+        """
+        if self._data_version is None:
+            return 0
+        data_version = self._execute("PRAGMA data_version")[0][0]
+        if data_version == self._data_version:
+            return 0
+        self._data_version = data_version
+        FEED.emit(self.s_class, None, 'reload')
+        return -1
+
+    def _stored(self, db: sqlite3.Connection, obj_id: str) -> dict:
+        """ Serialized dict of the row of an object, None if missing
+        """
+        row = db.execute("SELECT * FROM {} WHERE id = ?".format(
+            self.quote(self.s_class)), (obj_id,)).fetchone()
+        return None if row is None else dict(zip(row.keys(), row))
+
+    def _count(self, db: sqlite3.Connection, deltas: List[tuple]):
+        """ Adjust the aggregate counters by deltas (see
+        models.aggregates.changes) in the current transaction
+        """
+        totals = {}
+        for name, group, delta in deltas:
+            key = (name, json.dumps(group))
+            totals[key] = totals.get(key, 0) + delta
+        if not totals:
+            return
+        db.executemany(
+            "INSERT INTO {} (metric, grp, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (metric, grp) DO UPDATE SET "
+            "count = count + excluded.count".format(self.aggregates_table),
+            [key + (delta,) for key, delta in totals.items() if delta])
+        db.executemany(
+            "DELETE FROM {} WHERE metric = ? AND grp = ? AND count = 0"
+            .format(self.aggregates_table),
+            [key for key, delta in totals.items() if delta < 0])
+
+    def put_rows(self, rows: List[tuple]):
+        """ Insert or replace serialized rows
+        """
+        sql = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            self.quote(self.s_class),
+            ", ".join(self.quote(column) for column in self.sql_columns),
+            ", ".join("?" for _ in self.sql_columns))
+        deltas = []
+        with self._lock:
+            db = self.connection
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for row in rows:
+                    if self.metrics:
+                        data = dict(zip(self.sql_columns, row))
+                        deltas += changes(self.metrics,
+                                          self._stored(db, data['id']), data)
+                    db.execute(sql, row)
+                self._count(db, deltas)
+
+    def get(self, obj_id: str) -> TypeVar('Base'):
+        """ Return one object by ID (primary key lookup)
+        """
+        rows = self._execute("SELECT * FROM {} WHERE id = ?".format(
+            self.quote(self.s_class)), (obj_id,))
+        return self._load(rows[0]) if rows else None
+
+    def contains(self, obj_id: str) -> bool:
+        """ True if a row has this ID
+        """
+        return len(self._execute("SELECT 1 FROM {} WHERE id = ?".format(
+            self.quote(self.s_class)), (obj_id,))) > 0
+
+    def put(self, obj: TypeVar('Base')):
+        """ Insert or replace the row of an object
+        """
+        self.put_many([obj])
+
+    def put_if(self, obj: TypeVar('Base'), version: int) -> bool:
+        """ Replace the row as version + 1 only where its version is this
+        one
+        """
+        return self.put_many([obj], [version])[0]
+
+    def delete(self, obj_id: str) -> bool:
+        """ Delete the row of an object
+        """
+        return self.delete_many([obj_id])[0]
+
+    def delete_if(self, obj_id: str, version: int) -> bool:
+        """ Delete the row only where its version is this one
+        """
+        return self.delete_many([obj_id], [version])[0]
+
+    def put_many(self, objs: List[TypeVar('Base')],
+                 versions: List[int] = None) -> List[bool]:
+        """ Insert or replace several rows, each one as the stored version
+        + 1 where the stored one is the matching item of `versions` (None:
+        any version), in one transaction holding the write lock from its
+        start so that no other connection writes in between
+        """
+        if len(objs) == 0:
+            return []
+        insert = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            self.quote(self.s_class), ", ".join(
+                self.quote(column) for column in self.sql_columns),
+            ", ".join("?" for _ in self.sql_columns))
+        done = []
+        deltas = []
+        with self._lock:
+            db = self.connection
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for obj, version in zip(objs,
+                                        versions or [None] * len(objs)):
+                    old = self._stored(db, obj.id)
+                    stored = None if old is None else old['version'] or 0
+                    if version is not None and stored != version:
+                        done.append(False)
+                        continue
+                    obj.version = (stored or 0) + 1
+                    data = self.codec.dump(obj)
+                    db.execute(insert, self._row(data))
+                    deltas += changes(self.metrics, old, data)
+                    done.append(True)
+                self._count(db, deltas)
+        return done
+
+    def delete_many(self, obj_ids: List[str],
+                    versions: List[int] = None) -> List[bool]:
+        """ Delete several rows, each one only where its version is the
+        matching item of `versions` (None: any version), in one
+        transaction
+        """
+        if len(obj_ids) == 0:
+            return []
+        sql = "DELETE FROM {} WHERE id = ?".format(self.quote(self.s_class))
+        done = []
+        deltas = []
+        with self._lock:
+            db = self.connection
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for obj_id, version in zip(obj_ids,
+                                           versions or [None] * len(obj_ids)):
+                    old = self._stored(db, obj_id)
+                    if old is None or version is not None and \
+                            (old['version'] or 0) != version:
+                        done.append(False)
+                        continue
+                    db.execute(sql, (obj_id,))
+                    deltas += changes(self.metrics, old, None)
+                    done.append(True)
+                self._count(db, deltas)
+        return done
+
+    def aggregate(self, name: str) -> dict:
+        """ Number of objects by group of the metric `name`, from the
+        aggregates table
+        """
+        if name not in self.metrics:
+            raise ValueError("Unknown aggregate: {}".format(name))
+        rows = self._execute("SELECT grp, count FROM {} WHERE metric = ? "
+                             "AND grp != ''".format(self.aggregates_table),
+                             (name,))
+        return {json.loads(grp): count for grp, count in rows}
+
+    def _batches(self, where: str, params: tuple,
+                 columns: tuple) -> Iterator[TypeVar('Base')]:
+        """ Objects of the rows matching a condition in the order of
+        `columns` (unique), read BATCH_SIZE rows per query after the last
+        key read, so the lock isn't held between batches
+        """
+        after = None
+        while True:
+            condition = where
+            if after is not None:
+                condition += " AND ({}) > ({})".format(
+                    ", ".join(columns), ", ".join("?" for _ in columns))
+            rows = self._execute(
+                "SELECT * FROM {} WHERE {} ORDER BY {} LIMIT ?".format(
+                    self.quote(self.s_class), condition, ", ".join(columns)),
+                params + (after or ()) + (BATCH_SIZE,))
+            for row in rows:
+                yield self._load(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            after = tuple(rows[-1][column] for column in columns)
+
+    def scan(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects, in id order (a replaced row gets a
+        new rowid), BATCH_SIZE rows at a time
+        """
+        return self._batches("1", (), ("id",))
+
+    def count(self) -> int:
+        """ Number of rows
+        """
+        return self._execute("SELECT COUNT(*) FROM {}".format(
+            self.quote(self.s_class)))[0][0]
+
+    def page(self, order_by: str = 'id', after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Up to `limit` rows following the cursor `after` (indexed)
+        """
+        if order_by not in ORDERS:
+            raise ValueError("Unknown order: {}".format(order_by))
+        columns = "id" if order_by == 'id' else "created_at, id"
+        where = "1"
+        params = ()
+        if after is not None:
+            key = cursor_key(after, order_by)
+            if order_by == 'created_at':
+                key = (encode_timestamp(key[0]), key[1])
+            where = "({}) > ({})".format(columns, ", ".join("?" for _ in key))
+            params = key
+        rows = self._execute(
+            "SELECT * FROM {} WHERE {} ORDER BY {} LIMIT ?".format(
+                self.quote(self.s_class), where, columns),
+            params + (-1 if limit is None else limit,))
+        return [self._load(row) for row in rows]
+
+    def _range(self, predicate: TypeVar('Predicate')) -> tuple:
+        """ (order, SQL condition, parameters) of a range or prefix
+        predicate on id/created_at, None if the predicate isn't one of
+        those
+        """
+        low, high = None, None
+        if predicate.attribute == 'id' and predicate.op == 'prefix':
+            if type(predicate.value) is not str:
+                return None
+            low, high = predicate.value, predicate.value + '\U0010ffff'
+        elif predicate.op == 'range' and predicate.attribute in ORDERS and \
+                predicate.attribute in self.sql_columns:
+            low, high = predicate.value
+            if predicate.attribute == 'created_at':
+                bounds = timestamp_range(low, high)
+                if bounds is None:
+                    return None
+                low, high = (None if value is None
+                             else encode_timestamp(value)
+                             for value in bounds)
+            elif not all(value is None or type(value) is str
+                         for value in (low, high)):
+                return None
+        else:
+            return None
+        column = self.quote(predicate.attribute)
+        conditions = []
+        if low is not None:
+            conditions.append("{} >= ?".format(column))
+        if high is not None:
+            conditions.append("{} < ?".format(column))
+        return predicate.attribute, " AND ".join(conditions) or "1", \
+            tuple(value for value in (low, high) if value is not None)
+
+    def estimate(self, predicate: TypeVar('Predicate')) -> int:
+        """ Number of rows in the range of an id/created_at predicate
+        (counted on its index), else as StorageEngine.estimate
+        """
+        key_range = self._range(predicate)
+        if key_range is None:
+            return super().estimate(predicate)
+        return self._execute("SELECT COUNT(*) FROM {} WHERE {}".format(
+            self.quote(self.s_class), key_range[1]), key_range[2])[0][0]
+
+    def candidates(self, predicate: TypeVar('Predicate')
+                   ) -> Iterator[TypeVar('Base')]:
+        """ Rows in the range of an id/created_at predicate, in its order
+        and BATCH_SIZE rows per query, else as StorageEngine.candidates
+        """
+        key_range = self._range(predicate)
+        if key_range is None:
+            yield from super().candidates(predicate)
+            return
+        order, where, params = key_range
+        yield from self._batches(where, params, ("id",) if order == 'id'
+                                 else ("created_at", "id"))
+
+    def _where(self, attributes: dict) -> tuple:
+        """ SQL condition and parameters of attributes, None if some
+        attribute can't be matched in SQL
+        """
+        conditions = []
+        params = []
+        for k, v in attributes.items():
+            if type(v) is datetime and "_" + k in self.codec.fields:
+                v = v.strftime(TIMESTAMP_FORMAT)
+            elif k not in self.sql_columns or \
+                    k in ('created_at', 'updated_at'):
+                return None
+            if type(v) not in SQL_TYPES:
+                return None
+            if v is None:
+                conditions.append("{} IS NULL".format(self.quote(k)))
+            else:
+                conditions.append("{} = ?".format(self.quote(k)))
+                params.append(v)
+        return " AND ".join(conditions) or "1", tuple(params)
+
+    def lookup(self, attribute: str,
+               value) -> Iterable[TypeVar('Base')]:
+        """ Objects whose `attribute` is `value` (indexed query)
+        """
+        where = self._where({attribute: value})
+        if where is None:
+            return self.scan()
+        return [self._load(row) for row in self._select(where)]
+
+    def _select(self, where: tuple) -> list:
+        """ Rows matching a (clause, parameters) condition of _where
+        """
+        return self._execute("SELECT * FROM {} WHERE {} ORDER BY rowid"
+                             .format(self.quote(self.s_class), where[0]),
+                             where[1])
+
+    def search(self, attributes: dict) -> List[TypeVar('Base')]:
+        """ All objects with matching attributes, filtered in SQL
+        """
+        where = self._where(attributes)
+        if where is None:
+            return self.filter(self.scan(), attributes)
+        rows = self._select(where)
+        # Rows read from SQLite (filtered by its index or table scan)
+        METRICS.add(self.s_class, 'search_scanned', len(rows))
+        return [self._load(row) for row in rows]
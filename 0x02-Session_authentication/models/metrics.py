@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+""" Metrics module: timings, sizes and counts of the stores, per class
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import threading
+import time
+
+
+LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram():
+    """ Number of observed values by bucket (value <= bound), with their
+    count and sum
+    """
+
+    def __init__(self, bounds: tuple = LATENCY_BOUNDS):
+        """ Initialize an empty histogram
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        """ Add one value
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> Iterator[tuple]:
+        """ (bound, number of values <= bound) pairs, float('inf') last
+        """
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self) -> dict:
+        """ Count, sum and cumulative buckets by bound ('+Inf' last), the
+        bounds as strings like in the Prometheus format
+        """
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': {('+Inf' if bound == float('inf') else str(bound)):
+                            total for bound, total in self.cumulative()}}
+
+
+class Metrics():
+    """ Registry of the metrics of each class' store
+
+    Counters only grow (bytes_written, searches, search_scanned,
+    search_returned), gauges hold the last value (load_seconds,
+    load_objects) or are computed when read (objects,
+    objects_in_memory), and histograms count latencies (write_seconds,
+    save_to_file_seconds). Updates take a lock held for a few
+    operations only.
+    """
+
+    def __init__(self):
+        """ Initialize an empty registry
+        """
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._functions = {}
+
+    def add(self, s_class: str, name: str, amount: float = 1):
+        """ Increase a counter
+        """
+        with self._lock:
+            key = (s_class, name)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, s_class: str, name: str, value: float):
+        """ Set a gauge
+        """
+        with self._lock:
+            self.gauges[(s_class, name)] = value
+
+    def gauge(self, s_class: str, name: str, function: Callable[[], float]):
+        """ Gauge computed by function() each time the metrics are read
+        """
+        with self._lock:
+            self._functions[(s_class, name)] = function
+
+    def observe(self, s_class: str, name: str, value: float):
+        """ Add a value to a histogram
+        """
+        with self._lock:
+            histogram = self.histograms.get((s_class, name))
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[(s_class, name)] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, s_class: str, name: str):
+        """ Observe the duration (s) of the block in a histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(s_class, name, time.perf_counter() - start)
+
+    def _gauges(self) -> dict:
+        """ Set and computed gauges
+        """
+        with self._lock:
+            gauges = dict(self.gauges)
+            functions = list(self._functions.items())
+        for key, function in functions:
+            gauges[key] = function()
+        return gauges
+
+    def of(self, s_class: str) -> dict:
+        """ Metrics of one class by name (histograms as dicts)
+        """
+        return self.snapshot().get(s_class, {})
+
+    def snapshot(self) -> dict:
+        """ Metrics by class, then by name (histograms as dicts)
+        """
+        gauges = self._gauges()
+        result = {}
+        with self._lock:
+            for (s_class, name), value in list(self.counters.items()) + \
+                    list(gauges.items()):
+                result.setdefault(s_class, {})[name] = value
+            for (s_class, name), histogram in self.histograms.items():
+                result.setdefault(s_class, {})[name] = histogram.to_dict()
+        return result
+
+    def prometheus(self, prefix: str = 'store') -> str:
+        """ Metrics in the Prometheus text format, labelled by class
+        """
+        gauges = self._gauges()
+        lines = []
+
+        def family(name: str, kind: str, values: dict):
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for s_class, value in sorted(values.items()):
+                lines.append('{}_{}{{class="{}"}} {}'.format(
+                    prefix, name, s_class, value))
+
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(histogram.cumulative()),
+                                histogram.sum, histogram.count)
+                          for key, histogram in self.histograms.items()}
+        for kind, values, suffix in (('counter', counters, '_total'),
+                                     ('gauge', gauges, '')):
+            for name in sorted({name for _, name in values}):
+                family(name + suffix, kind, {
+                    s_class: value for (s_class, other), value
+                    in values.items() if other == name})
+        for name in sorted({name for _, name in histograms}):
+            lines.append("# TYPE {}_{} histogram".format(prefix, name))
+            for (s_class, other), (buckets, total, count) in \
+                    sorted(histograms.items()):
+                if other != name:
+                    continue
+                for bound, cumulative in buckets:
+                    lines.append('{}_{}_bucket{{class="{}",le="{}"}} {}'
+                                 .format(prefix, name, s_class,
+                                         '+Inf' if bound == float('inf')
+                                         else bound, cumulative))
+                lines.append('{}_{}_sum{{class="{}"}} {}'.format(
+                    prefix, name, s_class, total))
+                lines.append('{}_{}_count{{class="{}"}} {}'.format(
+                    prefix, name, s_class, count))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """ Forget the counters, set gauges and histograms
+        """
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+
+METRICS = Metrics()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+""" Query module
+"""
+from heapq import nlargest, nsmallest
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+from models.engines.engine import ORDERS, cursor_of, timestamp_range
+from models.metrics import METRICS
+
+
+class Predicate():
+    """ Condition on one attribute: eq, in, range or prefix
+    """
+
+    def __init__(self, attribute: str, op: str, value):
+        """ Initialize a predicate (range value: (low, high), high
+        excluded, None for an open bound)
+        """
+        self.attribute = attribute
+        self.op = op
+        self.value = value
+
+    def values(self) -> tuple:
+        """ Values matched by an eq/in predicate
+        """
+        return (self.value,) if self.op == 'eq' else tuple(self.value)
+
+    def match(self, obj: TypeVar('Base')) -> bool:
+        """ True if obj satisfies the predicate
+        """
+        value = getattr(obj, self.attribute)
+        if self.op == 'eq':
+            return value == self.value
+        if self.op == 'in':
+            return value in self.value
+        if self.op == 'prefix':
+            return type(value) is str and value.startswith(self.value)
+        low, high = self.value
+        if value is None:
+            return False
+        return (low is None or value >= low) and \
+            (high is None or value < high)
+
+    def __repr__(self) -> str:
+        """ Readable form, used by explain()
+        """
+        return "{} {} {!r}".format(self.attribute, self.op, self.value)
+
+
+class Query():
+    """ Lazy query over the objects of a Base subclass
+
+    Every method returns a new Query. The planner asks the storage engine
+    for the estimated candidates of each predicate (StorageEngine.estimate)
+    and reads the most selective one through its index; without any, it
+    scans, in index order when sorting by id or created_at on an engine
+    keeping sorted keys (StorageEngine.ordered).
+
+    Each iteration counts as a search in models.metrics, with the
+    candidates it scanned and the objects it returned (counted when it
+    ends, even if stopped early).
+    """
+
+    def __init__(self, cls: type):
+        """ Initialize a query on all objects of cls
+        """
+        self.cls = cls
+        self.predicates = []
+        self.order = None
+        self.descending = False
+        self.max_count = None
+
+    def _copy(self, **changes: dict) -> 'Query':
+        """ Copy of the query with some attributes changed
+        """
+        query = Query(self.cls)
+        query.__dict__.update(self.__dict__)
+        query.predicates = list(self.predicates)
+        query.__dict__.update(changes)
+        return query
+
+    def where(self, attributes: dict = None, **kwargs: dict) -> 'Query':
+        """ Attributes equal to values
+        """
+        attributes = dict(attributes or {}, **kwargs)
+        return self._copy(predicates=self.predicates + [
+            Predicate(k, 'eq', v) for k, v in attributes.items()])
+
+    def where_in(self, attribute: str, values: Iterable) -> 'Query':
+        """ Attribute equal to one of the values
+        """
+        return self._copy(predicates=self.predicates + [
+            Predicate(attribute, 'in', tuple(values))])
+
+    def where_range(self, attribute: str, low=None, high=None) -> 'Query':
+        """ low <= attribute < high (None: no bound)
+        """
+        return self._copy(predicates=self.predicates + [
+            Predicate(attribute, 'range', (low, high))])
+
+    def where_prefix(self, attribute: str, prefix: str) -> 'Query':
+        """ String attribute starting with prefix
+        """
+        return self._copy(predicates=self.predicates + [
+            Predicate(attribute, 'prefix', prefix)])
+
+    def order_by(self, attribute: str, descending: bool = False) -> 'Query':
+        """ Sort the results by attribute
+        """
+        return self._copy(order=attribute, descending=descending)
+
+    def limit(self, count: int) -> 'Query':
+        """ Return at most count objects
+        """
+        return self._copy(max_count=count)
+
+    def plan(self) -> dict:
+        """ Access path chosen for the query
+        """
+        engine = self.cls.engine()
+        best = None
+        for predicate in self.predicates:
+            estimate = engine.estimate(predicate)
+            if estimate is not None and \
+                    (best is None or estimate < best[1]):
+                best = (predicate, estimate)
+        total = engine.count()
+        if best is not None and best[1] < total:
+            access = {'access': 'index', 'predicate': best[0],
+                      'estimate': best[1]}
+        elif self.order in ORDERS and not self.descending and \
+                engine.ordered:
+            access = {'access': 'ordered scan', 'estimate': total}
+        else:
+            access = {'access': 'full scan', 'estimate': total}
+        if self.order is None or access['access'] == 'ordered scan':
+            access['sort'] = None
+        elif access['access'] == 'index' and not self.descending and \
+                access['predicate'].op in ('range', 'prefix') and \
+                access['predicate'].attribute == self.order:
+            # Sorted keys of the same order
+            access['sort'] = None
+        elif self.max_count is not None:
+            access['sort'] = 'top {}'.format(self.max_count)
+        else:
+            access['sort'] = 'sort'
+        access['limit'] = self.max_count
+        return access
+
+    def explain(self) -> dict:
+        """ Readable plan: access path, index predicate, estimated
+        candidates, sort and limit
+        """
+        plan = self.plan()
+        if 'predicate' in plan:
+            plan['predicate'] = repr(plan['predicate'])
+        return plan
+
+    def _ordered_scan(self) -> Iterator[TypeVar('Base')]:
+        """ Objects in index order, one page at a time, from the low bound
+        of a range predicate on the order to its high bound
+        """
+        engine = self.cls.engine()
+        low, high = None, None
+        for predicate in self.predicates:
+            if predicate.attribute == self.order and \
+                    predicate.op == 'range':
+                low, high = predicate.value
+                break
+        after = None
+        if low is not None and self.order == 'id':
+            # Cursors are exclusive: the low bound itself comes first
+            obj = engine.get(low) if type(low) is str else None
+            if obj is not None:
+                yield obj
+            after = low if type(low) is str else None
+        elif low is not None:
+            bounds = timestamp_range(low, None)
+            if bounds is not None:
+                # Before the first object of that second
+                after = "{}:".format(bounds[0])
+        while True:
+            objs = engine.page(self.order, after, 100)
+            for obj in objs:
+                value = getattr(obj, self.order)
+                if high is not None and value is not None and value >= high:
+                    return
+                yield obj
+            if len(objs) < 100:
+                return
+            after = cursor_of(objs[-1], self.order)
+
+    def __iter__(self) -> Iterator[TypeVar('Base')]:
+        """ Matching objects, fetched lazily
+        """
+        plan = self.plan()
+        engine = self.cls.engine()
+        if plan['access'] == 'index':
+            candidates = engine.candidates(plan['predicate'])
+        elif plan['access'] == 'ordered scan':
+            candidates = self._ordered_scan()
+        else:
+            candidates = engine.scan()
+        counts = {'scanned': 0, 'returned': 0}
+
+        def matching(objs):
+            for obj in objs:
+                counts['scanned'] += 1
+                if obj is not None and \
+                        all(p.match(obj) for p in self.predicates):
+                    yield obj
+
+        results = matching(candidates)
+        if plan['sort'] is not None:
+            def key(obj):
+                value = getattr(obj, self.order)
+                return (value is not None, value)
+            if self.max_count is not None:
+                top = nlargest if self.descending else nsmallest
+                results = iter(top(self.max_count, results, key=key))
+            else:
+                results = iter(sorted(results, key=key,
+                                      reverse=self.descending))
+        if self.max_count is not None:
+            results = islice(results, self.max_count)
+        return self._counted(results, counts)
+
+    def _counted(self, results: Iterator,
+                 counts: dict) -> Iterator[TypeVar('Base')]:
+        """ Results, recording the search in models.metrics once the
+        iteration ends
+        """
+        try:
+            for obj in results:
+                counts['returned'] += 1
+                yield obj
+        finally:
+            s_class = self.cls.__name__
+            METRICS.add(s_class, 'searches')
+            METRICS.add(s_class, 'search_scanned', counts['scanned'])
+            METRICS.add(s_class, 'search_returned', counts['returned'])
+
+    def all(self) -> List[TypeVar('Base')]:
+        """ List of the matching objects
+        """
+        return list(self)
+
+    def first(self) -> TypeVar('Base'):
+        """ First matching object, None if there is none
+        """
+        return next(iter(self.limit(1)), None)
+
+    def count(self) -> int:
+        """ Number of matching objects
+        """
+        return sum(1 for _ in self)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+""" Text index module: type-ahead search over words of text attributes
+"""
+from bisect import bisect_left, insort
+from typing import Iterable, List
+import re
+
+
+WORD = re.compile(r'[^\W_]+')
+
+
+def words_of(texts: Iterable[str]) -> frozenset:
+    """ Lowercase words (letters and digits) of some texts
+    """
+    return frozenset(word for text in texts if type(text) is str
+                     for word in WORD.findall(text.lower()))
+
+
+def match(words: frozenset, query_words: List[str]) -> bool:
+    """ True if each query word is the start of one of the words
+    """
+    return all(any(word.startswith(query_word) for word in words)
+               for query_word in query_words)
+
+
+class TextIndex():
+    """ Prefix index of the words of objects' text attributes
+
+    Words are kept sorted, each one with the IDs of the objects using
+    it (a plain ID while there is only one), so the objects having a
+    word starting with a prefix are found by bisection. A query matches
+    an object when each of its words starts one of the object's words
+    ("jo exa" matches john@example.com).
+    """
+
+    def __init__(self):
+        """ Initialize an empty index
+        """
+        self._words = []
+        self._ids = {}
+        self._tokens = {}
+
+    @classmethod
+    def of(cls, items: Iterable[tuple]) -> 'TextIndex':
+        """ Index of (ID, texts) pairs, sorted once
+        """
+        index = cls()
+        for obj_id, texts in items:
+            index._add(obj_id, texts)
+        index._words = sorted(index._ids)
+        return index
+
+    def _add(self, obj_id: str, texts: Iterable[str]) -> list:
+        """ Index the words of an object, return the new ones
+        """
+        words = words_of(texts)
+        self._tokens[obj_id] = words
+        new = []
+        for word in words:
+            ids = self._ids.get(word)
+            if ids is None:
+                self._ids[word] = obj_id
+                new.append(word)
+            elif type(ids) is set:
+                ids.add(obj_id)
+            else:
+                self._ids[word] = {ids, obj_id}
+        return new
+
+    def add(self, obj_id: str, texts: Iterable[str]):
+        """ Index (again) the texts of an object
+        """
+        self.remove(obj_id)
+        for word in self._add(obj_id, texts):
+            insort(self._words, word)
+
+    def remove(self, obj_id: str):
+        """ Remove an object from the index
+        """
+        for word in self._tokens.pop(obj_id, ()):
+            ids = self._ids[word]
+            if type(ids) is set:
+                ids.discard(obj_id)
+                if len(ids) > 1:
+                    continue
+                if len(ids) == 1:
+                    self._ids[word] = next(iter(ids))
+                    continue
+            del self._ids[word]
+            del self._words[bisect_left(self._words, word)]
+
+    def _range(self, prefix: str) -> tuple:
+        """ (start, end) of the sorted words starting with prefix
+        """
+        return (bisect_left(self._words, prefix),
+                bisect_left(self._words, prefix + '\U0010ffff'))
+
+    def _estimate(self, start: int, end: int) -> int:
+        """ Number of objects using the words in [start, end), counted
+        when there are few words, else the number of words
+        """
+        if end - start > 64:
+            return end - start
+        return sum(len(ids) if type(ids) is set else 1
+                   for ids in map(self._ids.get, self._words[start:end]))
+
+    def search(self, query: str, limit: int = None) -> List[str]:
+        """ IDs of the objects matching query, not ranked: in the
+        alphabetical order of the words matching its most selective word
+        """
+        query_words = WORD.findall(query.lower())
+        if len(query_words) == 0 or limit == 0:
+            return []
+        # Walk the words of the most selective query word
+        ranges = {word: self._range(word) for word in query_words}
+        prefix = min(ranges, key=lambda word: self._estimate(*ranges[word]))
+        others = [word for word in query_words if word != prefix]
+        results = []
+        seen = set()
+        start, end = ranges[prefix]
+        for i in range(start, end):
+            ids = self._ids[self._words[i]]
+            for obj_id in (ids if type(ids) is set else (ids,)):
+                if obj_id in seen:
+                    continue
+                seen.add(obj_id)
+                if match(self._tokens[obj_id], others):
+                    results.append(obj_id)
+                    if len(results) == limit:
+                        return results
+        return results
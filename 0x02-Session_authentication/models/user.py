@@ -3,11 +3,47 @@
 """
 import hashlib
 from models.base import Base
+from models.columns import attribute, epoch
+
+
+def created_day(data: dict) -> str:
+    """ Day of creation (YYYY-MM-DD) of a serialized User
+    """
+    created_at = data.get('created_at')
+    return created_at[:10] if type(created_at) is str else None
+
+
+def without_name(data: dict) -> bool:
+    """ True if a serialized User has neither first nor last name
+    """
+    if data.get('first_name') is None and data.get('last_name') is None:
+        return True
+    return None
+
+
+def email_domain(data: dict) -> str:
+    """ Domain (lowercase) of the email of a serialized User
+    """
+    email = data.get('email')
+    if type(email) is not str or '@' not in email:
+        return None
+    return email.rsplit('@', 1)[1].lower()
 
 
 class User(Base):
     """ User class
     """
+    __slots__ = ('email', '_password', 'first_name', 'last_name')
+    _indexed = ('email',)
+    _searchable = ('email', 'first_name', 'last_name')
+    _aggregates = {'created_per_day': created_day,
+                   'without_name': without_name,
+                   'email_domain': email_domain}
+    _columns = {'created_at': ('int', epoch('created_at')),
+                'updated_at': ('int', epoch('updated_at')),
+                'email_domain': ('category', email_domain),
+                'first_name': ('category', attribute('first_name')),
+                'last_name': ('category', attribute('last_name'))}
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance